@@ -0,0 +1,55 @@
+# coding: utf-8
+"""
+@namespace maestro
+Demo moving channels 0 and 1 of a Maestro, run with python -m maestro3
+"""
+import logging
+import os
+
+from .driver import Maestro, NotInitialized
+
+logger = logging.getLogger()
+handler = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.WARNING)
+
+url = ''
+servo = None
+if os.name == 'nt':
+    url = 'COM4'
+elif os.name == 'posix':
+    url = '/dev/ttyACM0'
+else:
+    logger.error('Not suported OS:', os.name)
+try:
+    servo = Maestro(url)
+except NotInitialized as e:
+    logger.error('Exit')
+    exit(-1)
+
+servo.go_home()
+print('start position0=', servo.get_position(0))
+print('start position1=', servo.get_position(1))
+logger.setLevel(logging.DEBUG)
+
+servo.set_target(0, 6000, 0, 11)  # set servo to move to center position
+servo.set_target(1, 6000, 0, 11, wait=True)  # set servo to move to center position
+print('position0=', servo.get_position(0))
+print('position1=', servo.get_position(1))
+
+print('position0=', servo.get_position(0))
+print('position0=', servo.get_position(1))
+
+servo.set_multiple_targets(2, 0, 7000, 1, 7002, wait=True)
+# servo.wait_until_at_target()
+print('multi position0=', servo.get_position(0))
+print('multi position1=', servo.get_position(1))
+
+servo.set_target(0, 3000, 500)  # set servo to move to center position
+servo.set_target(1, 3000, 500)  # set servo to move to center position
+servo.wait_until_at_target()
+servo.go_home()
+print('position=', servo.get_position(0))
+servo.close()
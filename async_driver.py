@@ -0,0 +1,328 @@
+# coding: utf-8
+"""
+@namespace maestro
+asyncio driver for the MiniMaestro Servo Controller.
+
+The serial port is used in non-blocking mode and served by the event loop: writes go straight
+to the file descriptor and one reader callback hands the replies out to the requests in the
+order they were sent, so several requests can be in flight and no thread is needed per device.
+Works on POSIX systems only (asyncio cannot watch serial handles on Windows).
+
+    async with AsyncMaestro('/dev/ttyACM0') as servo:
+        await servo.set_target(0, 7000, speed=20)
+        await servo.wait_until_at_target(timeout=5)
+        print(await servo.get_positions(range(6)))
+"""
+import asyncio
+import logging
+import os
+import sys
+from array import array
+from collections import deque
+
+import serial
+
+from .driver import Maestro, NotInitialized, ReadError
+from .encoder import COMPACT, Encoder, _DEVICE, _INIT_CMD
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncMaestro:
+    HOME_PULSE = Maestro.HOME_PULSE
+    MAX_FROM_HOME = Maestro.MAX_FROM_HOME
+    # Above this many unsent bytes the setters wait for the port to drain
+    HIGH_WATER = 4096
+
+    def __init__(self, port="/dev/ttyACM0", baudrate=9600, timeout=3, protocol=COMPACT, device=_DEVICE):
+        """Class constructor block, must be called with a running event loop
+
+        @param port The serial port to communicate through (default: /dev/ttyACM0)
+        @param baudrate The baudrate to open communications at (default: 9600)
+        @param timeout The default timeout in seconds of the requests (default: 3)
+        @param protocol The framing of the commands, COMPACT or POLOLU (default: COMPACT)
+        @param device The device number addressed by the POLOLU framing (default: 0x0c)
+        @return New AsyncMaestro object
+        """
+        self._loop = asyncio.get_running_loop()
+        self._encoder = Encoder(protocol, device)
+        self.timeout = timeout
+        try:
+            self._commandPort = serial.Serial(port=port, baudrate=baudrate, timeout=0)
+        except serial.serialutil.SerialException as e:
+            logger.error(e)
+            raise NotInitialized(e)
+
+        self._fd = self._commandPort.fileno()
+        os.set_blocking(self._fd, False)
+        self._writeBuffer = bytearray()
+        self._readBuffer = bytearray()
+        self._pending = deque()  # (size, future) of the requests waiting for their reply
+        self._drained = None
+        self._loop.add_reader(self._fd, self._on_readable)
+        self._write(bytes([_INIT_CMD]))
+        logger.info("Command Port initialized successfully")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def is_open(self):
+        """ Check if the serial connection to the Maestro is Open
+        @return True if open, False otherwise
+        """
+        return self._commandPort.isOpen()
+
+    def close(self, error=None):
+        """Close the serial port, the requests waiting for a reply fail with ReadError
+        @param[in] error The exception set on the waiting requests, ReadError('port closed') if None
+        """
+        if not self._commandPort.isOpen():
+            return
+        logger.info("Closing command port: %s", self._commandPort.port)
+        self._loop.remove_reader(self._fd)
+        self._loop.remove_writer(self._fd)
+        self._fail_pending(error or ReadError('port closed'))
+        if self._drained is not None and not self._drained.done():
+            self._drained.set_result(None)
+        self._commandPort.close()
+
+    def _write(self, data):
+        """Write as much as possible now and queue the rest until the port is writable"""
+        if not self._commandPort.isOpen():
+            return False
+        if not self._writeBuffer:
+            try:
+                written = os.write(self._fd, data)
+            except BlockingIOError:
+                written = 0
+            except OSError as e:
+                self._lost(e)
+                return False
+            if written == len(data):
+                return True
+            data = data[written:]
+            self._loop.add_writer(self._fd, self._on_writable)
+        self._writeBuffer += data
+        return True
+
+    def _on_writable(self):
+        try:
+            written = os.write(self._fd, self._writeBuffer)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._lost(e)
+            return
+        del self._writeBuffer[:written]
+        if not self._writeBuffer:
+            self._loop.remove_writer(self._fd)
+            if self._drained is not None and not self._drained.done():
+                self._drained.set_result(None)
+
+    async def drain(self):
+        """Wait until every queued byte has been handed over to the port"""
+        if self._writeBuffer:
+            if self._drained is None or self._drained.done():
+                self._drained = self._loop.create_future()
+            await self._drained
+
+    async def write(self, data):
+        """ Write a message to the command port
+        @brief The bytes are written or copied before the first await, so data may be a view of the encoder buffer.
+        @param[in] data The bytes to write to the device
+        @return True if the write was successful, False otherwise
+        """
+        if not self._write(data):
+            logger.info("Serial port closed. Please open the serial port!")
+            return False
+        if len(self._writeBuffer) > self.HIGH_WATER:
+            await self.drain()
+        return True
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._lost(e)
+            return
+        if not data:
+            self._lost('end of file')
+            return
+        self._readBuffer += data
+        while self._pending and len(self._readBuffer) >= self._pending[0][0]:
+            size, future = self._pending.popleft()
+            if not future.done():
+                future.set_result(bytes(self._readBuffer[:size]))
+            del self._readBuffer[:size]
+        if not self._pending and self._readBuffer:
+            logger.warning('dropping %d unexpected bytes', len(self._readBuffer))
+            del self._readBuffer[:]
+
+    def _lost(self, reason):
+        """The device went away: stop watching the port, fail the pending requests and close it"""
+        logger.error("Command port %s lost: %s", self._commandPort.port, reason)
+        self.close(ReadError('port lost: {}'.format(reason)))
+
+    def _fail_pending(self, error):
+        while self._pending:
+            size, future = self._pending.popleft()
+            if not future.done():
+                future.set_exception(error)
+        del self._readBuffer[:]
+
+    async def _request(self, data, size, timeout=None):
+        """Send a request and wait for its reply
+        @brief Requests are pipelined: the reply is matched by its position in the queue of
+        pending requests. If a reply times out the stream cannot be matched any more, so every
+        pending request fails and the received bytes are dropped.
+        @param[in] data The request
+        @param[in] size The size of the reply
+        @param[in] timeout The timeout in seconds, self.timeout if None
+        @return The reply bytes
+        @throws ReadError if the reply did not arrive in time
+        """
+        future = self._loop.create_future()
+        self._pending.append((size, future))
+        if not await self.write(data):
+            if future.done():
+                future.exception()  # failed by close, the error is raised below
+            else:
+                self._pending.remove((size, future))
+            raise ReadError('port closed')
+        try:
+            return await asyncio.wait_for(future, self.timeout if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            received = bytes(self._readBuffer)
+            self._fail_pending(ReadError('request timed out'))
+            raise ReadError('expected {} bytes, got {}'.format(size, len(received)), received)
+
+    async def set_target(self, channel, target, speed=None, acceleration=None, wait=False):
+        """Sends a set target command to the controller, see Maestro.set_target
+        @param[in] channel The channel to control by target (integer)
+        @param[in] target The integer value to trasmit as pulse width in units of quarter-microseconds
+        @param[in] speed The speed limit sent before the target if given, see set_speed
+        @param[in] acceleration The acceleration limit sent before the target if given, see set_acceleration
+        @param[in] wait Wait until the servos reach their targets
+        @return True if the target write was successful, False otherwise
+        """
+        outStr = bytearray()
+        if speed:
+            outStr += self._encoder.set_speed(channel, speed)
+        if acceleration:
+            outStr += self._encoder.set_acceleration(channel, acceleration)
+        outStr += self._encoder.set_target(channel, target)
+        ret = await self.write(outStr)
+        if wait:
+            await self.wait_until_at_target()
+        return ret
+
+    async def set_target_percent(self, channel, percent):
+        """Sends a set target command given a percentage, see Maestro.set_target_percent
+        @param[in] channel The channel to control by target (integer)
+        @param[in] percent The integer value from -100 to 100 to transmit as a pulse width
+        @return True if the target write was successful, False otherwise
+        """
+        return await self.set_target(channel, self.percent2command(percent))
+
+    async def set_targets(self, targets, wait=False):
+        """Sets the targets of any number of channels at once, see Maestro.set_targets
+        @param[in] targets A dict {channel: target} of targets in units of quarter-microseconds
+        @param[in] wait Wait until the servos reach their targets
+        @return True if all targets were written successfully, False otherwise
+        """
+        ret = await self.write(self._encoder.set_targets(targets)) if targets else True
+        if wait:
+            await self.wait_until_at_target()
+        return ret
+
+    async def set_speed(self, channel, speed):
+        """Sends the speed command to the maestro channel, see Maestro.set_speed
+        @param[in] channel The channel of which to set the speed
+        @param[in] speed The speed limit of the rate of output value change in units of (0.25 microseconds)/(10 ms).
+        @return True if the speed was successfully set, False otherwise
+        """
+        return await self.write(self._encoder.set_speed(channel, speed))
+
+    async def set_acceleration(self, channel, acceleration):
+        """Sets the acceleration limit of the servo channel, see Maestro.set_acceleration
+        @param[in] channel The channel of which to set the speed
+        @param[in] acceleration The acc. limit of the channels output in units of (0.25 microseconds)/(10 ms)/(80 ms)
+        @return True if the acceleration was set successfully, False otherwise
+        """
+        return await self.write(self._encoder.set_acceleration(channel, acceleration))
+
+    async def set_PWM(self, onTime, period):
+        """Sets the PWM to the specified onTime and period, see Maestro.set_PWM
+        @param[in] onTime On time value in units of 1/48 microseconds
+        @param[in] period Period value in units of 1/48 microseconds
+        @return True if the PWM was set successfully, False otherwise
+        """
+        return await self.write(self._encoder.set_PWM(onTime, period))
+
+    async def go_home(self):
+        """Returns all servos back to home position, see Maestro.go_home
+        @return True if successfully, False otherwise
+        """
+        return await self.write(self._encoder.go_home())
+
+    percent2command = Maestro.percent2command
+
+    async def get_position(self, channel, timeout=None):
+        """Returns the position of the given channel, see Maestro.get_position
+        @param[in] channel The channel of which to get the position
+        @param[in] timeout The timeout in seconds, self.timeout if None
+        @return The current position
+        @throws ReadError if the reply did not arrive in time
+        """
+        lowbits, highbits = await self._request(self._encoder.get_position(channel), 2, timeout)
+        return lowbits + (highbits << 8)
+
+    async def get_positions(self, channels, timeout=None):
+        """Returns the positions of several channels with one request, see Maestro.get_positions
+        @param[in] channels An iterable of the channels of which to get the position
+        @param[in] timeout The timeout in seconds for the whole reply, self.timeout if None
+        @return array('H') of the positions in the order of channels
+        @throws ReadError if the reply did not arrive in time
+        """
+        channels = bytes(channels)
+        positions = array('H')
+        if channels:
+            positions.frombytes(await self._request(self._encoder.get_positions(channels), 2 * len(channels),
+                                                    timeout))
+            if sys.byteorder == 'big':
+                positions.byteswap()
+        return positions
+
+    async def get_moving_state(self, timeout=None):
+        """Get the current motion state of the servos, see Maestro.get_moving_state
+        @param[in] timeout The timeout in seconds, self.timeout if None
+        @return 1 if moving, 0 if not in motion
+        @throws ReadError if the reply did not arrive in time
+        """
+        data = await self._request(self._encoder.get_moving_state(), 1, timeout)
+        return data[0]
+
+    async def wait_until_at_target(self, timeout=None):
+        """Wait until no servo is moving any more
+        @param[in] timeout The maximum time to wait in seconds, no limit if None
+        @throws asyncio.TimeoutError if the servos are still moving after timeout
+        """
+        async def poll():
+            while await self.get_moving_state():
+                await asyncio.sleep(0.01)
+
+        await asyncio.wait_for(poll(), timeout)
+
+    async def get_errors(self, timeout=None):
+        """Returns any errors that the Maestro has detected, see Maestro.get_errors
+        @param[in] timeout The timeout in seconds, self.timeout if None
+        @return The error code read from the servo as (lowbits, highbits)
+        @throws ReadError if the reply did not arrive in time
+        """
+        lowbits, highbits = await self._request(self._encoder.get_errors(), 2, timeout)
+        return lowbits, highbits
@@ -0,0 +1,182 @@
+# coding: utf-8
+"""
+@namespace maestro
+Benchmarks of the driver: command throughput, query round trip latency and encoding overhead.
+
+Runs against the emulator by default, or against a real device with --port, for every baud rate
+and framing (compact or pololu) given, and prints the results as JSON:
+
+    python -m maestro3.bench --baudrate 9600 115200 --framing compact pololu --output bench.json
+"""
+import argparse
+import json
+import platform
+import sys
+from time import perf_counter, time
+
+from .driver import COMPACT, POLOLU, Maestro
+from .emulator import MaestroEmulator
+
+FRAMINGS = (COMPACT, POLOLU)
+# Timeout of the query waiting for the device to process a throughput measure
+SYNC_TIMEOUT = 120
+
+
+def _percentile(samples, percent):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100.0))]
+
+
+def _rate(count, seconds):
+    return count / seconds if seconds else None
+
+
+def _throughput(servo, count, command):
+    """Commands per second of command(i), until the device has processed all of them
+    @brief The port buffers the writes, so the time ends with a query answered after the last command.
+    """
+    start = perf_counter()
+    for i in range(count):
+        command(i)
+    servo.get_positions([0], timeout=SYNC_TIMEOUT)
+    return _rate(count, perf_counter() - start)
+
+
+def measure_throughput(servo, count, channels):
+    """Commands per second of the setters
+    @param[in] servo An open Maestro
+    @param[in] count The number of commands sent per measure
+    @param[in] channels The number of channels set by each set_targets
+    @return A dict of the rates
+    """
+    setTarget = _throughput(servo, count, lambda i: servo.set_target(i % channels, 4000 + i % 4000))
+    setTargets = _throughput(servo, count, lambda i: servo.set_targets({channel: 4000 + (i + channel) % 4000
+                                                                        for channel in range(channels)}))
+    setPWM = _throughput(servo, count, lambda i: servo.set_PWM(i % 4800, 4800))
+    return {
+        'set_target_per_s': setTarget,
+        'set_targets_per_s': setTargets,
+        'set_targets_channels_per_s': setTargets * channels if setTargets else None,
+        'set_PWM_per_s': setPWM,
+    }
+
+
+def measure_latency(servo, count):
+    """Round trip latency of the queries
+    @param[in] servo An open Maestro
+    @param[in] count The number of round trips per query
+    @return A dict of the p50 and p99 latencies in milliseconds
+    """
+    queries = {
+        'get_position': lambda: servo.get_position(0),
+        'get_moving_state': servo.get_moving_state,
+        'get_errors': servo.get_errors,
+    }
+    result = {}
+    for name, query in queries.items():
+        samples = []
+        for i in range(count):
+            start = perf_counter()
+            query()
+            samples.append((perf_counter() - start) * 1000.0)
+        result[name + '_p50_ms'] = _percentile(samples, 50)
+        result[name + '_p99_ms'] = _percentile(samples, 99)
+    return result
+
+
+def measure_encoding(servo, count, channels):
+    """Python side cost of the setters, without any I/O
+    @brief The commands are encoded into a frame which is dropped instead of committed.
+    @param[in] servo An open Maestro
+    @param[in] count The number of commands encoded per measure
+    @param[in] channels The number of channels set by each set_targets
+    @return A dict of the costs in microseconds per command
+    """
+    result = {}
+    commands = {
+        'set_target': lambda i: servo.set_target(i % channels, 4000 + i % 4000),
+        'set_targets': lambda i: servo.set_targets({channel: 4000 + (i + channel) % 4000
+                                                    for channel in range(channels)}),
+        'set_speed': lambda i: servo.set_speed(i % channels, i % 256),
+        'set_PWM': lambda i: servo.set_PWM(i % 4800, 4800),
+    }
+    for name, command in commands.items():
+        servo.begin()
+        start = perf_counter()
+        for i in range(count):
+            command(i)
+        elapsed = perf_counter() - start
+        servo.abort()
+        result[name + '_encode_us'] = elapsed / count * 1e6
+    return result
+
+
+def run(port=None, baudrates=(9600, 115200), framings=FRAMINGS, count=1000, samples=100, channels=12):
+    """Run every benchmark for every baud rate and framing
+    @param[in] port The port of a real device, the emulator if None
+    @param[in] baudrates The baud rates to test
+    @param[in] framings The protocol framings to test
+    @param[in] count The number of commands of the throughput and encoding measures
+    @param[in] samples The number of round trips of the latency measures
+    @param[in] channels The number of channels set by set_targets
+    @return A list of dicts, one per baud rate and framing
+    """
+    results = []
+    for baudrate in baudrates:
+        for framing in framings:
+            emulator = None
+            servo = None
+            if port is None:
+                emulator = MaestroEmulator(baudrate=baudrate)
+                emulator.start()
+            try:
+                servo = Maestro(port=emulator.port if emulator else port, baudrate=baudrate, protocol=framing)
+                # the throughput measures write far faster than a slow line drains, block instead of timing out
+                servo._commandPort.write_timeout = None
+                result = {
+                    'port': 'emulator' if emulator else port,
+                    'baudrate': baudrate,
+                    'framing': framing,
+                    'count': count,
+                    'samples': samples,
+                    'channels': channels,
+                }
+                result.update(measure_encoding(servo, count, channels))
+                result.update(measure_throughput(servo, count, channels))
+                result.update(measure_latency(servo, samples))
+            finally:
+                if servo is not None:
+                    servo.close()
+                if emulator:
+                    emulator.stop()
+            results.append(result)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Maestro driver')
+    parser.add_argument('--port', help='serial port of a real device, the emulator is used if not given')
+    parser.add_argument('--baudrate', type=int, nargs='+', default=[9600, 115200])
+    parser.add_argument('--framing', nargs='+', default=list(FRAMINGS), choices=FRAMINGS)
+    parser.add_argument('--count', type=int, default=1000, help='commands per throughput/encoding measure')
+    parser.add_argument('--samples', type=int, default=100, help='round trips per latency measure')
+    parser.add_argument('--channels', type=int, default=12, help='channels set by set_targets')
+    parser.add_argument('--output', help='write the JSON to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    report = {
+        'time': time(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'results': run(args.port, args.baudrate, args.framing, args.count, args.samples, args.channels),
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
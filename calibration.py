@@ -0,0 +1,132 @@
+# coding: utf-8
+"""
+@namespace maestro
+Per-channel calibration of servos, compiled into lookup tables.
+
+A Calibration maps a percentage, -100 to 100, or an angle to a target in quarter-microseconds: 0 % is the
+home pulse, 100 % the max pulse and -100 % the min pulse, so the endpoints need not be symmetric. The
+direction can be inverted and an optional curve corrects a nonlinear linkage. All of it is evaluated
+once, when the Calibration is created, into a table of targets indexed by the percentage in steps of
+1/resolution %; a conversion is then a rounding and an index, for one value or, with NumPy, for whole
+arrays. A CalibrationTable stacks the tables of several channels to convert frames of all of them at once.
+
+    arm = Calibration(min=4200, max=7600, home=5900, invert=True, degrees=180)
+    servo.calibrate(0, arm)
+    servo.set_target_percent(0, 50)
+"""
+from array import array
+
+try:
+    import numpy
+except ImportError:  # numpy is optional, only the bulk conversions need it
+    numpy = None
+
+
+class Calibration:
+    """Percent and angle to target conversion of one channel"""
+
+    def __init__(self, min=4000, max=8000, home=6000, invert=False, curve=None, degrees=180.0, resolution=10):
+        """Class constructor block
+
+        @param min The target at -100 % in quarter-microseconds (default: 4000)
+        @param max The target at 100 % in quarter-microseconds (default: 8000)
+        @param home The target at 0 % in quarter-microseconds (default: 6000)
+        @param invert Swap the directions, 100 % goes to min (default: False)
+        @param curve A function mapping -1.0..1.0 to -1.0..1.0 applied to the fraction of the way to the
+                     endpoint, None for linear (default: None)
+        @param degrees The angle between the min and the max targets, centered on home (default: 180)
+        @param resolution The number of table entries per percent (default: 10)
+        @return New Calibration object
+        """
+        if not min <= home <= max:
+            raise ValueError('expected min <= home <= max, got {}, {}, {}'.format(min, home, max))
+        self.min = min
+        self.max = max
+        self.home = home
+        self.invert = invert
+        self.curve = curve
+        self.degrees = degrees
+        self.resolution = resolution
+        self.table = array('H', (self._evaluate(i / resolution - 100) for i in range(200 * resolution + 1)))
+        self._last = len(self.table) - 1
+
+    def _evaluate(self, percent):
+        fraction = percent / 100.0
+        if self.invert:
+            fraction = -fraction
+        if self.curve is not None:
+            fraction = self.curve(fraction)
+        if fraction >= 0:
+            return int(round(self.home + fraction * (self.max - self.home)))
+        return int(round(self.home + fraction * (self.home - self.min)))
+
+    def __repr__(self):
+        return 'Calibration(min={}, max={}, home={}, invert={})'.format(self.min, self.max, self.home, self.invert)
+
+    def percent(self, percent):
+        """Target of a percentage, clamped to -100..100
+        @param[in] percent A number from -100 to 100
+        @return The target in quarter-microseconds
+        """
+        index = int(round((percent + 100) * self.resolution))
+        return self.table[min(max(index, 0), self._last)]
+
+    def angle(self, degrees):
+        """Target of an angle from home, clamped to the range of the servo
+        @param[in] degrees The angle, positive towards 100 %
+        @return The target in quarter-microseconds
+        """
+        return self.percent(degrees * 200.0 / self.degrees)
+
+    def percents(self, values):
+        """Targets of an array of percentages, see percent
+        @param[in] values An array-like of any shape
+        @return A uint16 NumPy array of the same shape
+        """
+        values = numpy.asarray(values, dtype=numpy.float64)
+        index = numpy.rint((values + 100) * self.resolution).astype(numpy.intp)
+        numpy.clip(index, 0, self._last, out=index)
+        return numpy.frombuffer(self.table, dtype=numpy.uint16)[index]
+
+    def angles(self, values):
+        """Targets of an array of angles, see angle
+        @param[in] values An array-like of any shape
+        @return A uint16 NumPy array of the same shape
+        """
+        return self.percents(numpy.asarray(values, dtype=numpy.float64) * (200.0 / self.degrees))
+
+
+class CalibrationTable:
+    """The Calibrations of a fixed set of channels, converting frames of all of them at once (NumPy)"""
+
+    def __init__(self, calibrations):
+        """Class constructor block
+
+        @param calibrations A sequence of Calibration, one per column of the frames, sharing one resolution
+        @return New CalibrationTable object
+        """
+        calibrations = list(calibrations)
+        resolutions = {calibration.resolution for calibration in calibrations}
+        if len(resolutions) != 1:
+            raise ValueError('the calibrations must have the same resolution')
+        self.calibrations = calibrations
+        self.resolution = resolutions.pop()
+        self._last = 200 * self.resolution
+        self._tables = numpy.array([numpy.frombuffer(calibration.table, dtype=numpy.uint16)
+                                    for calibration in calibrations])
+        self._columns = numpy.arange(len(calibrations))
+        self._scales = numpy.array([200.0 / calibration.degrees for calibration in calibrations])
+
+    def percents(self, frames):
+        """Targets of frames of percentages
+        @param[in] frames An array-like whose last axis has one value per calibration
+        @return A uint16 NumPy array of the same shape, ready for TrajectoryStreamer
+        """
+        frames = numpy.asarray(frames, dtype=numpy.float64)
+        index = numpy.rint((frames + 100) * self.resolution).astype(numpy.intp)
+        numpy.clip(index, 0, self._last, out=index)
+        return self._tables[self._columns, index]
+
+    def angles(self, frames):
+        """Targets of frames of angles, see percents"""
+        return self.percents(numpy.asarray(frames, dtype=numpy.float64) * self._scales)
@@ -10,10 +10,21 @@ Written using the documentation found here: http://www.pololu.com/docs/0J40/all#
 https://www.pololu.com/docs/0J40/5.e
 
 """
-from time import sleep
+import logging
+import sys
+from array import array
+from contextlib import contextmanager
+from time import monotonic, perf_counter, sleep
 
 import serial
 
+from .encoder import COMPACT, POLOLU, Encoder, _DEVICE, _INIT_CMD  # noqa: F401
+from . import ports
+from .kinematics import MotionModel
+from .stats import IOStats
+
+logger = logging.getLogger(__name__)
+
 
 class NotInitialized(Exception):
     '''Raise when device is not initialized and you try using it'''
@@ -30,17 +41,12 @@ class InitError(Exception):
     pass
 
 
-#
-_DEVICE = 0x0c  # type: int
-_SET_MULTIPLE_TARGET_CMD = 0x9F  # type: int
-_SET_ACCELERATION_CMD = 0x89  # type: int
-_GET_POSITION_CMD = 0x90  # type: int
-_SET_TARGET_CMD = 0x84  # type: int
-_GET_ERRORS_CMD = 0xA1  # type: int
-_SET_SPEED_CMD = 0x87  # type: int
-_SET_PWM_CMD = 0x8A  # type: int
-_GO_HOME_CMD = 0xA2  # type: int
-_INIT_CMD = 0xAA  # type: int
+class ReadError(Exception):
+    """Raise if the reply of the device is shorter than expected. The bytes received are in data"""
+
+    def __init__(self, message, data=b''):
+        super().__init__(message)
+        self.data = data
 
 
 class Maestro:
@@ -50,73 +56,497 @@ class Maestro:
     MAX_FORWARD_SPEED = HOME_PULSE + MAX_FROM_HOME
     MAX_REVERSE_SPEED = HOME_PULSE - MAX_FROM_HOME
     SERVO_RANGE = MAX_FROM_HOME * 2
-    pololu_cmd = bytearray([0xaa, _DEVICE])
+    # wait_until_at_target checks the device this long before the predicted end of the moves
+    ARRIVAL_MARGIN = 0.02
+    # Baud rates tried by negotiate_baudrate, fastest first
+    BAUDRATES = (200000, 115200, 57600, 38400, 19200, 9600)
 
-    def __init__(self, port="/dev/ttyACM0", baudrate=9600):
+    def __init__(self, port="/dev/ttyACM0", baudrate=9600, shadow=False, protocol=COMPACT, device=_DEVICE,
+                 threaded=False, detect_baud=True):
         """Class constructor block
 
-        @param port The serial port to communicate through (defualt: /dev/ttyACMO)
+        @param port The serial port to communicate through (defualt: /dev/ttyACMO). The Maestros of a process
+                    opening the same port share one handle, see ports. An open serial.Serial is used as is
+                    and left open by close
         @param baudrate The baudrate to open communications at (default: 9600)
+        @param shadow Skip writing targets, speeds, accelerations and PWM equal to the last ones sent (default: False)
+        @param protocol The framing of the commands, COMPACT or POLOLU (default: COMPACT)
+        @param device The device number addressed by the POLOLU framing (default: 0x0c)
+        @param threaded Start the background I/O worker, see start_worker (default: False)
+        @param detect_baud Send the baud rate detection byte 0xAA when opening the port, False before
+                           negotiate_baudrate (default: True)
         @return New Maestro object
         """
-        self._commandPort = serial.Serial(port=port, baudrate=baudrate)
-        if self._commandPort.isOpen():
-            self._commandPort.close()
+        self._encoder = Encoder(protocol, device)
+        self._worker = None
+        self._stats = None
+        self._frameBuffer = bytearray()
+        self._frameDepth = 0
+        self._frameFailed = False  # an inner frame raised, the outermost commit drops the buffer
+        # Shadow state: the last values sent per channel. Always recorded, only used to suppress writes if shadow
+        self._shadow = shadow
+        self._targets = {}
+        self._speeds = {}
+        self._accelerations = {}
+        self._pwm = None
+        # Replay record: the last values which reached the port, keyed ('target' | 'speed' | 'acceleration',
+        # channel) or ('pwm', None). Unlike the shadow state it survives get_errors and abort, see resync
+        self._sent = {}
+        self._unsent = []  # (key, value) recorded in the current frame, moved to _sent once it is written
+        self._motion = MotionModel()
+        self._calibrations = {}  # channel -> Calibration used by the percent setters
+        self._closed = False
+        self._ownsPort = False
+        if isinstance(port, serial.SerialBase):
+            self._commandPort = port
+            if not self.is_open():
+                raise NotInitialized("Command Port NOT initialized.")
+        else:
+            self._open(port, baudrate, detect_baud)
+            self._ownsPort = True
+        # held around each write and each request with its reply, the handle may be shared, see ports
+        self._portLock = ports.lock(self._commandPort)
+
+        if threaded:
+            self.start_worker()
+
+    def _open(self, port, baudrate, detect=True):
+        """Open the command port configured in one go and send the initialization byte, or share the handle
+        if the port is already open, see ports.acquire
+        """
         try:
-            self._commandPort.timeout = 3
-            self._commandPort.writeTimeout = 0.5
-            self._commandPort.open()
-        except serial.serialutil.SerialException as e:
+            self._commandPort = ports.acquire(port, baudrate, detect)
+        except (serial.serialutil.SerialException, ValueError) as e:
+            # ValueError: the port is shared at another baud rate, e.g. after negotiate_baudrate
             logger.error(e)
             raise NotInitialized(e)
-
-        # Send a quick initialization byte if the port was opened
-        if self._commandPort.isOpen() and self._commandPort.writable():
-            self._commandPort.write(bytes(_INIT_CMD))
-            self._commandPort.flush()
-            logger.info("Command Port initialized successfully")
-        else:
-            raise NotInitialized("Command Port NOT initialized.")
+        logger.info("Command Port initialized successfully")
 
     def __del__(self):
         """Class destructor block"""
-        if self._commandPort.isOpen():
-            logger.info("Deleting command port: {}".format(self._commandPort.port))
-            self._commandPort.close()
+        if getattr(self, '_ownsPort', False) and not self._closed:
+            logger.info("Deleting command port: %s", self._commandPort.port)
+            self._closed = True
+            ports.release(self._commandPort)
+
+    @property
+    def encoder(self):
+        """The Encoder of the commands, in the framing of this Maestro"""
+        return self._encoder
 
     def is_open(self):
         """ Check if the serial connection to the Maestro is Open
         @return True if open, False otherwise
         """
-        return self._commandPort.isOpen() and self._commandPort.writable()
+        return not self._closed and self._commandPort.isOpen() and self._commandPort.writable()
 
     def close(self):
-        """Close the serial port"""
-        if self._commandPort.isOpen():
-            logger.info("Closing command port: {}".format(self._commandPort.port))
-            self._commandPort.close()
+        """Close the serial port, once no other Maestro shares it"""
+        self.stop_worker()
+        if not self._closed:
+            self._closed = True
+            if self._ownsPort:
+                logger.info("Closing command port: %s", self._commandPort.port)
+                ports.release(self._commandPort)
+
+    def negotiate_baudrate(self, baudrates=None, timeout=0.05):
+        """Find the fastest baud rate the Maestro answers reliably and switch the port to it
+        @brief For each rate, fastest first, the port is switched to it, the baud rate detection byte is
+        sent and Get Errors is sent twice: the first reply clears what the other rates left, the second
+        must come back complete and without error.
+        In "UART, detect baud rate" mode the Maestro locks onto the rate of the first 0xAA it receives
+        until it is reset. So the device must be freshly reset and this Maestro opened with
+        detect_baud=False, and the rate locked is the first one whose 0xAA reaches the device: if the
+        probe then fails the device needs a reset before trying slower rates. In "UART, fixed baud rate"
+        mode the probe finds the configured rate, but bytes sent at the wrong rates can be read as other
+        commands, so only run it with the outputs in a safe state. Over the USB virtual port any rate
+        works. The port is shared: every Maestro on it switches too, and later ones must open it at
+        the rate returned.
+        @param[in] baudrates The rates to try in order (default: BAUDRATES)
+        @param[in] timeout The read timeout in seconds of each probe
+        @return The baud rate selected
+        @throws InitError if no rate works, the port is back to its previous rate
+        """
+        if self._worker is not None:
+            raise RuntimeError('stop the I/O worker before negotiating the baud rate')
+        port = self._commandPort
+        with self._portLock:
+            previous = port.baudrate
+            for baudrate in baudrates or self.BAUDRATES:
+                port.baudrate = baudrate
+                port.reset_input_buffer()
+                self.write(_INIT_CMD)
+                try:
+                    self._query('get_errors', (), 2, timeout)
+                    if self._query('get_errors', (), 2, timeout) == b'\x00\x00':
+                        logger.info("Negotiated %d baud on %s", baudrate, port.port)
+                        return baudrate
+                except ReadError:
+                    pass
+            port.baudrate = previous
+            port.reset_input_buffer()
+        raise InitError('no baud rate answered on {}'.format(port.port))
+
+    def resync(self, quiet=0.02):
+        """Recover from a protocol error or a stuck read without reopening the port
+        @brief Drops the frame being built, discards the input until the line stays quiet, clears the
+        errors of the device with Get Errors, then sends the last targets, speeds, accelerations and PWM
+        written again with one write. They come from the replay record, which get_errors, abort and
+        invalidate leave alone, so resync still works after get_errors reported the fault; go_home clears
+        the targets of it. The I/O worker, if running, is restarted around it.
+        @param[in] quiet The input is drained until nothing arrived for this many seconds
+        @return The errors read, as get_errors, False if the port is not writable
+        @throws ReadError if the device does not answer Get Errors
+        """
+        worker = self._worker is not None
+        self.stop_worker()
+        self._frameDepth = 0
+        self._frameFailed = False
+        del self._frameBuffer[:]
+        del self._unsent[:]
+        sent = dict(self._sent)
+        self.invalidate()
+        try:
+            port = self._commandPort
+            with self._portLock:
+                portTimeout = port.timeout
+                port.reset_input_buffer()
+                port.timeout = quiet
+                try:
+                    while port.read(max(1, port.in_waiting)):
+                        pass
+                finally:
+                    port.timeout = portTimeout
+                errors = self.get_errors()
+            if errors is False:
+                return False
+            self.invalidate()
+            targets = {}
+            with self.frame():
+                for (kind, channel), value in sent.items():
+                    if kind == 'speed':
+                        self.set_speed(channel, value)
+                    elif kind == 'acceleration':
+                        self.set_acceleration(channel, value)
+                    elif kind == 'pwm':
+                        self.set_PWM(*value)
+                    else:
+                        targets[channel] = value
+                # the targets last, once the limits are back
+                if targets:
+                    self.set_targets(targets)
+            logger.info("Resynchronized %s, errors %s", port.port, errors)
+            return errors
+        finally:
+            if worker:
+                self.start_worker()
+
+    def enable_stats(self, hook=None):
+        """Start counting the I/O, see stats
+        @param[in] hook A callable hook(event, seconds, size) called after every write, flush and query
+                        round trip, see IOStats
+        @return The IOStats, its counters start from zero
+        """
+        self._stats = IOStats(hook)
+        return self._stats
+
+    def disable_stats(self):
+        """Stop counting the I/O, the I/O paths then skip all instrumentation"""
+        self._stats = None
+
+    def stats(self):
+        """Counters of the I/O since enable_stats
+        @brief Commands sent per type, bytes written and read, writes, flushes and reads issued to the port,
+        reads which timed out, and latency histograms of the writes, the flushes and the round trip of each
+        query type.
+        @return A dict, see IOStats.snapshot, None if the statistics are disabled
+        """
+        return self._stats.snapshot() if self._stats is not None else None
+
+    def start_worker(self):
+        """Start the background I/O worker
+        @brief From then on the setters and write only queue their commands and return at once, and the
+        queries wait for their reply from the worker, so the Maestro can be shared by several threads. The
+        worker thread alone uses the port and sends everything queued with one write: a target queued for a
+        channel replaces the one still waiting for that channel. Frames have no effect while it runs.
+        @return The IOWorker
+        """
+        from .worker import IOWorker
+
+        if self._worker is None:
+            self._worker = IOWorker(self)
+            self._worker.start()
+        return self._worker
+
+    def stop_worker(self):
+        """Send the commands queued and stop the background I/O worker
+        @brief The worker is detached only once its thread has ended, so other threads cannot use the port
+        while it still writes its last batch; meanwhile their commands are refused.
+        """
+        worker = self._worker
+        if worker is not None:
+            worker.stop()
+            self._worker = None
 
     def write(self, *data):
         """ Write a message to the command port
-        Handles writing the commands to the Maestro device
+        Handles writing the commands to the Maestro device. All messages are collected in one buffer and sent
+        with a single write and flush. Inside a frame (see begin) they are only buffered until commit.
         @param[in] data A list of commands to write to the device
         @return True if the write was successful, False otherwise
         """
-        if not self._commandPort.isOpen() or not self._commandPort.writable():
+        if not self.is_open():
             logger.info("Serial port closed. Please open the serial port!")
             return False
+        if self._worker is not None:
+            return self._worker.put_raw(b''.join(bytes([m]) if isinstance(m, int) else bytes(m) for m in data))
 
         for message in data:
             if isinstance(message, int):
-                self._commandPort.write(bytes(message))
-            elif isinstance(message, (bytes, bytearray, int)):
-                self._commandPort.write(message)
+                self._frameBuffer.append(message)
+            elif isinstance(message, (bytes, bytearray, memoryview)):
+                self._frameBuffer += message
             else:
-                raise TypeError('expected int bytes or bytearray, got %s'.format(type(data)))
+                raise TypeError('expected int bytes or bytearray, got {}'.format(type(message)))
 
-        self._commandPort.flush()
+        if self._frameDepth:
+            return True
+        return self._send()
+
+    def _send(self):
+        """Write the buffered commands to the command port with one write and one flush
+        @brief If the write fails the shadow state is invalidated: it may hold values of the buffer, which
+        were recorded when they were buffered but never reached the device.
+        """
+        stats = self._stats
+        try:
+            with self._portLock:
+                if stats is None:
+                    if self._frameBuffer:
+                        self._commandPort.write(self._frameBuffer)
+                    self._commandPort.flush()
+                else:
+                    start = perf_counter()
+                    if self._frameBuffer:
+                        self._commandPort.write(self._frameBuffer)
+                        written = perf_counter()
+                        stats.write(written - start, len(self._frameBuffer))
+                        start = written
+                    self._commandPort.flush()
+                    stats.flush(perf_counter() - start)
+        except BaseException:
+            del self._unsent[:]
+            self.invalidate()
+            raise
+        finally:
+            del self._frameBuffer[:]
+        self._written()
         return True
 
+    def _remember(self, key, value):
+        """Add a value to the replay record, once the frame holding it is written
+        @param[in] key ('target' | 'speed' | 'acceleration', channel), ('pwm', None) or ('home', None) which
+                       drops the targets
+        @param[in] value The value written
+        """
+        self._unsent.append((key, value))
+        if not self._frameDepth:
+            self._written()
+
+    def _written(self):
+        """Move the values of the frame just written to the replay record"""
+        sent = self._sent
+        for key, value in self._unsent:
+            if key[0] == 'home':
+                for stale in [k for k in sent if k[0] == 'target']:
+                    del sent[stale]
+            else:
+                sent[key] = value
+        del self._unsent[:]
+
+    def _command(self, name, *args):
+        """Send the command encoded by encoder.<name>(*args), or queue it for the I/O worker
+        @return True if the write was successful, False otherwise
+        """
+        if self._stats is not None:
+            self._stats.command(name)
+        if self._worker is not None:
+            return self._worker.put(name, args)
+        return self.write(getattr(self._encoder, name)(*args))
+
+    def _query(self, name, args, size, timeout=None):
+        """Send the request encoded by encoder.<name>(*args) and read its reply
+        @param[in] size The size of the reply
+        @param[in] timeout The read timeout in seconds, the port timeout if None
+        @return The reply, None if the write failed
+        @throws ReadError if the reply is incomplete
+        """
+        stats = self._stats
+        if stats is not None:
+            stats.command(name)
+            start = perf_counter()
+        if self._worker is not None:
+            data = self._worker.query(name, args, size, timeout)
+        else:
+            # the reply must be read before another user of the port sends a request
+            with self._portLock:
+                if not self._request(getattr(self._encoder, name)(*args)):
+                    return None
+                data = self._read(size, timeout)
+        if stats is not None:
+            stats.query(name, perf_counter() - start, size)
+        return data
+
+    def _request(self, request):
+        """Write a request which the Maestro answers
+        Inside a frame the commands buffered so far are sent together with the request, otherwise
+        the reply could never arrive.
+        @param[in] request The request command
+        @return True if the write was successful, False otherwise
+        """
+        status = self.write(request)
+        if status and self._frameDepth:
+            self._send()
+        return status
+
+    def begin(self):
+        """Start a frame
+        @brief Until the matching commit, set_target, set_targets, set_speed, set_acceleration, set_PWM
+        and go_home only append their commands to a buffer. Frames may be nested, only the outermost
+        commit sends the buffer. If an inner frame fails (see frame) the outermost commit drops it.
+        """
+        self._frameDepth += 1
+
+    def commit(self, into=None):
+        """End a frame and send all commands buffered in it with one write and one flush
+        @param[in] into A bytearray to append the commands to instead of sending them, e.g. to send the
+                        frames of several devices sharing the port with one write. The commands are only
+                        recorded as sent once confirm is called with the result of that write
+        @return True if the write was successful, False otherwise or if an inner frame failed
+        """
+        if not self._frameDepth:
+            raise RuntimeError('commit without begin')
+        self._frameDepth -= 1
+        if self._frameDepth:
+            return True
+        if self._frameFailed:
+            self._discard()
+            return False
+        if not self._frameBuffer:
+            # everything was sent with a request or queued for the I/O worker
+            self._written()
+            return True
+        if into is not None:
+            into += self._frameBuffer
+            del self._frameBuffer[:]
+            return True
+        if not self.is_open():
+            self.abort()
+            logger.info("Serial port closed. Please open the serial port!")
+            return False
+        return self._send()
+
+    def confirm(self, written):
+        """Settle the commands appended to a buffer by commit(into=...) once that buffer was written
+        @param[in] written True if the write was successful: the commands are recorded as sent, otherwise
+                           they are dropped and the shadow state is invalidated
+        """
+        if written:
+            self._written()
+        else:
+            del self._unsent[:]
+            self.invalidate()
+
+    def abort(self):
+        """Leave all frames and drop the commands buffered in them
+        @brief The shadow state is invalidated since it already holds the dropped values.
+        """
+        self._frameDepth = 0
+        self._discard()
+
+    def _fail(self):
+        """Leave the current frame after an error
+        @brief The frames around it stay open, so the begin/commit pairs of the caller still match,
+        but their outermost commit drops the whole buffer.
+        """
+        self._frameDepth -= 1
+        if self._frameDepth:
+            self._frameFailed = True
+        else:
+            self._discard()
+
+    def _discard(self):
+        """Drop the buffered commands and the values recorded with them"""
+        del self._frameBuffer[:]
+        del self._unsent[:]
+        self._frameFailed = False
+        self.invalidate()
+
+    def invalidate(self, channel=None):
+        """Forget the shadow state so that the next setters write their values again
+        @brief Call it when the device state changed behind the driver's back, e.g. a script
+        running on the Maestro or a power cycle. The replay record of resync is kept.
+        @param[in] channel The channel to forget, all channels and the PWM if None
+        """
+        self._motion.forget(channel)
+        if channel is None:
+            self._targets.clear()
+            self._speeds.clear()
+            self._accelerations.clear()
+            self._pwm = None
+        else:
+            self._targets.pop(channel, None)
+            self._speeds.pop(channel, None)
+            self._accelerations.pop(channel, None)
+
+    def record_targets(self, targets):
+        """Add targets written with write, behind the setters, to the replay record of resync
+        @brief Without it resync would send those channels back to the last targets of the setters.
+        The shadow state is not updated, see invalidate.
+        @param[in] targets A dict {channel: target} of the targets last written
+        """
+        for channel, target in targets.items():
+            self._remember(('target', channel), target)
+
+    def _record(self, state, kind, channel, value, status):
+        """Update the shadow state and the replay record after a write
+        @param[in] state The shadow dict of the command
+        @param[in] kind The key of the command in the replay record: 'target', 'speed' or 'acceleration'
+        @param[in] channel The channel written
+        @param[in] value The value written
+        @param[in] status The write status, the channel is forgotten if False
+        @return status
+        """
+        if status:
+            state[channel] = value
+            self._remember((kind, channel), value)
+            target = self._targets.get(channel)
+            if target is not None:
+                self._motion.move(channel, target, self._speeds.get(channel), self._accelerations.get(channel))
+        else:
+            state.pop(channel, None)
+            self._motion.forget(channel)
+        return status
+
+    @contextmanager
+    def frame(self):
+        """Context manager around begin/commit
+        @brief The commands are sent when the block exits and dropped if it raises:
+            with servo.frame():
+                servo.set_target(0, 6000)
+                servo.set_speed(1, 20)
+                servo.set_target(1, 7000)
+        A nested frame which raises also drops the commands of the frames around it, when the
+        outermost one exits.
+        """
+        self.begin()
+        try:
+            yield self
+        except BaseException:
+            self._fail()
+            raise
+        self.commit()
+
     def set_target(self, channel, target, speed=None, acceleration=None, wait=False):
         """Sends a set target command to the controller
         @brief The target is a non-negative integer. If the channel is configured as a servo,
@@ -128,13 +558,23 @@ class Maestro:
         @param[in] target The integer value to trasmit as pulse width in units of quarter-microseconds
         @return True if the target write was successful, False otherwise
         """
-        if speed:
-            self.set_speed(channel, speed)
-        if acceleration:
-            self.set_acceleration(channel, acceleration)
+        self.begin()
+        try:
+            if speed:
+                self.set_speed(channel, speed)
+            if acceleration:
+                self.set_acceleration(channel, acceleration)
 
-        outStr = bytearray([0xaa, _DEVICE, 0x04, channel, self.low_bits(target), self.high_bits(target)])
-        ret = self.write(outStr)
+            if self._shadow and self._targets.get(channel) == target:
+                ret = True
+            else:
+                ret = self._record(self._targets, 'target', channel, target,
+                                   self._command('set_target', channel, target))
+        except BaseException:
+            self._fail()
+            raise
+        if not self.commit():
+            ret = False
         if wait:
             self.wait_until_at_target('wait in set target')
         return ret
@@ -149,13 +589,62 @@ class Maestro:
         @param[in] percent The integer value from -100 to 100 to transmit as a pulse width
         @return True if the target write was successful, False otherwise
         """
-        target = self.percent2command(percent)
+        calibration = self._calibrations.get(channel)
+        target = self.percent2command(percent) if calibration is None else calibration.percent(percent)
         return self.set_target(channel, target)
 
+    def set_targets_percent(self, percents, wait=False):
+        """Sets the targets of any number of channels given as percentages, see set_targets
+        @param[in] percents A dict {channel: percent} of values from -100 to 100
+        @return True if all targets were written successfully, False otherwise
+        """
+        calibrations = self._calibrations
+        targets = {}
+        for channel, percent in percents.items():
+            calibration = calibrations.get(channel)
+            targets[channel] = self.percent2command(percent) if calibration is None else calibration.percent(percent)
+        return self.set_targets(targets, wait=wait)
+
+    def calibrate(self, channel, calibration):
+        """Set the calibration used to convert the percentages of a channel
+        @param[in] channel The channel
+        @param[in] calibration A Calibration, None to go back to HOME_PULSE and MAX_FROM_HOME
+        """
+        if calibration is None:
+            self._calibrations.pop(channel, None)
+        else:
+            self._calibrations[channel] = calibration
+
+    def calibration(self, channel):
+        """The Calibration of a channel, None if it uses HOME_PULSE and MAX_FROM_HOME"""
+        return self._calibrations.get(channel)
+
+    def set_targets(self, targets, wait=False):
+        """Sets the targets of any number of channels at once
+        @brief Set Multiple Targets (0x9F) only addresses a range of consecutive channels, so the channels
+        are sorted and split into contiguous runs. Each run is encoded as a single 0x9F packet (a Set Target
+        if it has one channel) and all packets are sent with one write. {0: 6000, 1: 6100, 2: 6200, 5: 4000}
+        becomes two packets: channels 0-2 and channel 5.
+        @param[in] targets A dict {channel: target} of targets in units of quarter-microseconds
+        @return True if all targets were written successfully, False otherwise
+        """
+        if self._shadow:
+            targets = {channel: target for channel, target in targets.items()
+                       if self._targets.get(channel) != target}
+
+        ret = True
+        if targets:
+            ret = self._command('set_targets', dict(targets))
+            for channel, target in targets.items():
+                self._record(self._targets, 'target', channel, target, ret)
+        if wait:
+            self.wait_until_at_target('wait in set targets')
+        return ret
+
     def set_multiple_targets(self, num_targets, channel1, target1, channel2, target2, channel3=None, target3=None,
                              channel4=None, target4=None, wait=False):
-        """ Original has not worked. works only if you want set range of servos
-        Set multiple servo targets at one time
+        """ Set multiple servo targets at one time
+        @brief Kept for compatibility, use set_targets which takes any number of channels.
         @param[in] numChannels The number of channels to be changed with command (min=2, max=4)
         @param[in] channel(i) The channel to control by target (integer)
         @param[in] target[i] The integer value to trasmit as pulse width in units of (0.25 microseconds)
@@ -166,17 +655,8 @@ class Maestro:
             logger.error("Invalid number of targets")
             return False
 
-        self.set_target(channel1, target1)
-        self.set_target(channel2, target2)
-
-        if num_targets > 2:
-            self.set_target(channel3, target3)
-        if num_targets > 3:
-            self.set_target(channel4, target4)
-
-        if wait:
-            self.wait_until_at_target('wait in multi set target')
-        return True
+        pairs = ((channel1, target1), (channel2, target2), (channel3, target3), (channel4, target4))
+        return self.set_targets(dict(pairs[:num_targets]), wait=wait)
 
     def set_speed(self, channel, speed):
         """Sends the speed command to the maestro channel
@@ -190,9 +670,10 @@ class Maestro:
         @param[in] speed The speed limit of the rate of output value change in units of (0.25 microseconds)/(10 ms).
         @return True if the speed was successfully set, False otherwise
         """
-        logger.info("set speed CHAN({0}) = {1}".format(channel, speed))
-        outStr = bytearray([_SET_SPEED_CMD, channel, self.low_bits(speed), self.high_bits(speed)])
-        return self.write(outStr)
+        if self._shadow and self._speeds.get(channel) == speed:
+            return True
+        logger.info("set speed CHAN(%s) = %s", channel, speed)
+        return self._record(self._speeds, 'speed', channel, speed, self._command('set_speed', channel, speed))
 
     def set_acceleration(self, channel, acceleration):
         """Sets the acceleration limit of the servo channel
@@ -209,9 +690,11 @@ class Maestro:
         @param[in] acceleration The acc. limit of the channels output in units of (0.25 microseconds)/(10 ms)/(80 ms)
         @return True if the acceleration was set successfully, False otherwise
         """
-        logger.info("set acceleration CHAN({0}) = {1}".format(channel, acceleration))
-        outStr = bytearray([_SET_ACCELERATION_CMD, channel, self.low_bits(acceleration), self.high_bits(acceleration)])
-        return self.write(outStr)
+        if self._shadow and self._accelerations.get(channel) == acceleration:
+            return True
+        logger.info("set acceleration CHAN(%s) = %s", channel, acceleration)
+        ret = self._command('set_acceleration', channel, acceleration)
+        return self._record(self._accelerations, 'acceleration', channel, acceleration, ret)
 
     def set_PWM(self, onTime, period):
         """Sets the PWM to the specified onTime and period
@@ -231,9 +714,13 @@ class Maestro:
         @param[in] period Period value in units of 1/48 microseconds
         @return True if the PWM was set successfully, False otherwise
         """
-        outStr = bytearray([_SET_PWM_CMD, self.low_bits(onTime), self.high_bits(onTime), self.low_bits(period),
-                            self.high_bits(period)])
-        return self.write(outStr)
+        if self._shadow and self._pwm == (onTime, period):
+            return True
+        ret = self._command('set_PWM', onTime, period)
+        self._pwm = (onTime, period) if ret else None
+        if ret:
+            self._remember(('pwm', None), (onTime, period))
+        return ret
 
     def get_position(self, channel: int):
         """Returns the position of the given channel
@@ -253,17 +740,44 @@ class Maestro:
         @return The current position. Read more in the brief. If the write failed, the function will return -1.
         """
         logger.info('get position')
-        status = self.write(bytearray([_GET_POSITION_CMD, channel]))
-        if not status:
+        data = self._query('get_position', (channel,), 2)
+        if data is None:
             return -1
 
-        lowbits = ord(self._commandPort.read(1))
-        highbits = ord(self._commandPort.read(1))
+        lowbits, highbits = data
         position = lowbits + (highbits << 8)
-        if logger.level == logging.DEBUG:
-            logger.debug('Position CHAN({0}) = {1}'.format(channel, position))
+        self._motion.observe(channel, position)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Position CHAN(%d) = %d', channel, position)
         return position
 
+    def get_positions(self, channels, timeout=None):
+        """Returns the positions of several channels with one write and one read
+        @brief All Get Position requests are sent at once and the 2 bytes replies are read together,
+        so the cost is a single round trip instead of one per channel. See get_position for the
+        meaning of the values. The result can be used as a NumPy array without a copy:
+        numpy.frombuffer(positions, dtype=numpy.uint16)
+        @param[in] channels An iterable of the channels of which to get the position
+        @param[in] timeout The timeout in seconds for the whole reply, the port timeout if None
+        @return array('H') of the positions in the order of channels, None if the write failed
+        @throws ReadError if the reply is incomplete, the bytes received are in its data
+        """
+        channels = bytes(channels)
+        positions = array('H')
+        if not channels:
+            return positions
+        data = self._query('get_positions', (channels,), 2 * len(channels), timeout)
+        if data is None:
+            return None
+
+        positions.frombytes(data)
+        if sys.byteorder == 'big':
+            positions.byteswap()
+        now = monotonic()
+        for channel, position in zip(channels, positions):
+            self._motion.observe(channel, position, now)
+        return positions
+
     def get_moving_state(self):
         """Get the current motion state of the servo
         @brief This command is used to determine whether the servo outputs have reached their
@@ -273,21 +787,47 @@ class Maestro:
         next step of your program.
         @return 1 if moving, 0 if not in motion, -1 if the write failed
         """
-        outStr = self.pololu_cmd
-        outStr.append(0x13)
-
-        self.write(outStr)
-        data = self._commandPort.read(1)
-        if data:
-            return data[0]
-        else:
+        try:
+            data = self._query('get_moving_state', (), 1)
+        except ReadError:
             return None
+        if data is None:
+            return -1
+        return data[0]
 
     def wait_until_at_target(self, m=''):
-        logger.info('wait until at target {}'.format(m))
-        while self.get_moving_state():
+        """Wait until no servo is moving any more
+        @brief If the end of the moves can be predicted from the targets, speeds and accelerations
+        sent (see estimate_move_time) it sleeps until shortly before then, so usually a single
+        Get Moving State confirms the arrival. Otherwise the device is polled every 10 ms.
+        @param[in] m A message to log
+        @throws NotWritable if Get Moving State cannot be written, e.g. the port is closed
+        """
+        logger.info('wait until at target %s', m)
+        arrival = self._motion.arrival()
+        if arrival is not None:
+            delay = arrival - monotonic() - self.ARRIVAL_MARGIN
+            if delay > 0:
+                sleep(delay)
+        while True:
+            moving = self.get_moving_state()
+            if moving == -1:
+                raise NotWritable('cannot poll the moving state, the port is not writable')
+            if not moving:
+                return
             sleep(0.01)
 
+    def estimate_move_time(self, channel, target):
+        """Predicts how long a move of channel to target sent now would take, without using the port
+        @brief The prediction uses the speed and acceleration limits last sent to the channel and its
+        estimated position, see kinematics.
+        @param[in] channel The channel to move
+        @param[in] target The target in quarter-microseconds
+        @return The duration in seconds, None if the limits or the position of the channel are not known
+        """
+        return self._motion.estimate_move_time(channel, target, self._speeds.get(channel),
+                                               self._accelerations.get(channel))
+
     def go_home(self):
         """Returns all servos back to home position
         @brief This command sends all servos and outputs to their home positions, just
@@ -296,8 +836,13 @@ class Maestro:
         @return True if successfully, False otherwise
         """
         logger.info('go home')
-        data = _GO_HOME_CMD
-        return self.write(data)
+        # the targets are now the home positions configured on the device
+        self._targets.clear()
+        self._motion.forget()
+        ret = self._command('go_home')
+        if ret:
+            self._remember(('home', None), None)
+        return ret
 
     def get_errors(self):
         """Returns any errors that the Maestro has detected.
@@ -330,18 +875,44 @@ class Maestro:
         Script program counter error (bit 8) -- This error occurs when a bug in the user script has caused the program counter (the address of the next
                                                 instruction to be executed) to go out of bounds. This can happen if your program is not terminated by a quit,
                                                 return, or infinite loop.
+        A nonzero reply invalidates the shadow state, see invalidate; the last values written are kept for
+        resync to send them again.
         @return The error code read from the servo, or False if unsuccessful
         """
         logger.info('get errors')
-        status = self.write(_GET_ERRORS_CMD)
-        if not status:
+        data = self._query('get_errors', (), 2)
+        if data is None:
             return False
 
         # Get the response bytes
-        lowbits = ord(self._commandPort.read(1))
-        highbits = ord(self._commandPort.read(1))
+        lowbits, highbits = data
+        if lowbits or highbits:
+            # an error may have dropped commands or sent the servos home
+            self.invalidate()
         return lowbits, highbits
 
+    def _read(self, size, timeout=None):
+        """Read a reply of the device
+        @param[in] size The number of bytes expected
+        @param[in] timeout The timeout in seconds, the port timeout if None
+        @return The bytes read
+        @throws ReadError if fewer bytes arrived before the timeout
+        """
+        if timeout is None or timeout == self._commandPort.timeout:
+            data = self._commandPort.read(size)
+        else:
+            portTimeout = self._commandPort.timeout
+            self._commandPort.timeout = timeout
+            try:
+                data = self._commandPort.read(size)
+            finally:
+                self._commandPort.timeout = portTimeout
+        if self._stats is not None:
+            self._stats.read(len(data), size)
+        if len(data) < size:
+            raise ReadError('expected {} bytes, got {}'.format(size, len(data)), data)
+        return data
+
     @classmethod
     def low_bits(cls, value):
         """Returns the lower 7 bits to be passed as a control sequence (bits 0-6)
@@ -360,60 +931,9 @@ class Maestro:
 
     def percent2command(self, percent):
         """Process the percent value given for the servo control
+        @brief The same conversion for every channel, see calibrate for per-channel endpoints
         @param[in] percent An integer value between -100 and 100.
         @return the equivalent value to send the servo a desired pulse-width
         """
         shift = int((percent / 100.0) * self.MAX_FROM_HOME)
         return self.HOME_PULSE + shift
-
-
-if __name__ == "__main__":
-    import logging
-
-    logger = logging.getLogger()
-    handler = logging.StreamHandler()
-    formatter = logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    logger.setLevel(logging.WARNING)
-
-    import os
-
-    url = ''
-    servo = None
-    if os.name == 'nt':
-        url = 'COM4'
-    elif os.name == 'posix':
-        url = '/dev/ttyACM0'
-    else:
-        logger.error('Not suported OS:', os.name)
-    try:
-        servo = Maestro(url)
-    except NotInitialized as e:
-        logger.error('Exit')
-        exit(-1)
-
-    servo.go_home()
-    print('start position0=', servo.get_position(0))
-    print('start position1=', servo.get_position(1))
-    logger.setLevel(logging.DEBUG)
-
-    servo.set_target(0, 6000, 0, 11)  # set servo to move to center position
-    servo.set_target(1, 6000, 0, 11, wait=True)  # set servo to move to center position
-    print('position0=', servo.get_position(0))
-    print('position1=', servo.get_position(1))
-
-    print('position0=', servo.get_position(0))
-    print('position0=', servo.get_position(1))
-
-    servo.set_multiple_targets(2, 0, 7000, 1, 7002, wait=True)
-    # servo.wait_until_at_target()
-    print('multi position0=', servo.get_position(0))
-    print('multi position1=', servo.get_position(1))
-
-    servo.set_target(0, 3000, 500)  # set servo to move to center position
-    servo.set_target(1, 3000, 500)  # set servo to move to center position
-    servo.wait_until_at_target()
-    servo.go_home()
-    print('position=', servo.get_position(0))
-    servo.close()
@@ -0,0 +1,275 @@
+# coding: utf-8
+"""
+@namespace maestro
+Software Maestro speaking the serial protocol on a pseudo-terminal.
+
+The emulator answers the commands used by the driver in both the compact and the Pololu protocol,
+moves the channels every 10 ms following the speed and acceleration limits like the device, and
+delays bytes as the configured baud rate would. It makes the driver usable without hardware:
+
+    with MaestroEmulator(baudrate=115200) as emulator:
+        servo = Maestro(port=emulator.port, baudrate=115200)
+        servo.set_target(0, 7000, speed=20, wait=True)
+
+POSIX only (uses pty).
+"""
+import logging
+import os
+import select
+import threading
+import tty
+from math import sqrt
+from time import monotonic, sleep
+
+from .encoder import (_DEVICE, _GET_ERRORS_CMD, _GET_MOVING_STATE_CMD, _GET_POSITION_CMD, _GO_HOME_CMD, _INIT_CMD,
+                      _SET_ACCELERATION_CMD, _SET_MULTIPLE_TARGET_CMD, _SET_PWM_CMD, _SET_SPEED_CMD, _SET_TARGET_CMD)
+from .kinematics import UPDATE_PERIOD
+
+logger = logging.getLogger(__name__)
+
+# Error bits of Get Errors
+SERIAL_SIGNAL_ERROR = 1 << 0
+SERIAL_OVERRUN_ERROR = 1 << 1
+SERIAL_RX_BUFFER_FULL = 1 << 2
+SERIAL_CRC_ERROR = 1 << 3
+SERIAL_PROTOCOL_ERROR = 1 << 4
+SERIAL_TIMEOUT_ERROR = 1 << 5
+
+# Number of data bytes following each command byte, None when it depends on the data
+_DATA_SIZE = {
+    _SET_TARGET_CMD: 3,
+    _SET_SPEED_CMD: 3,
+    _SET_ACCELERATION_CMD: 3,
+    _SET_PWM_CMD: 4,
+    _GET_POSITION_CMD: 1,
+    _GET_MOVING_STATE_CMD: 0,
+    _SET_MULTIPLE_TARGET_CMD: None,
+    _GET_ERRORS_CMD: 0,
+    _GO_HOME_CMD: 0,
+}
+
+
+class MaestroEmulator:
+    """Emulated Maestro on a pseudo-terminal, open self.port with the driver"""
+
+    def __init__(self, channels=24, device=_DEVICE, baudrate=9600, home=6000):
+        """Class constructor block
+
+        @param channels The number of channels (default: 24, a Mini Maestro 24)
+        @param device The device number answering in the Pololu protocol (default: 0x0c)
+        @param baudrate The baud rate whose byte timing is emulated, None for no delay (default: 9600)
+        @param home The home position of the channels, a number or a list per channel (default: 6000)
+        @return New MaestroEmulator object
+        """
+        self.channels = channels
+        self.device = device
+        self.baudrate = baudrate
+        self.home = list(home) if isinstance(home, (list, tuple)) else [home] * channels
+        self.targets = list(self.home)
+        self.positions = [float(h) for h in self.home]
+        self.velocities = [0.0] * channels
+        self.speeds = [0] * channels
+        self.accelerations = [0] * channels
+        self.pwm = (0, 0)
+        self.errors = 0
+        self.lock = threading.Lock()
+
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._running = False
+        self.port = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        """Open the pseudo-terminal and start serving it
+        @return The name of the port to open
+        """
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        # the slave stays open here, otherwise reads on the master fail while the driver reopens the port
+        self.port = os.ttyname(self._slave)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='maestro-emulator', daemon=True)
+        self._thread.start()
+        logger.info("Emulator listening on %s", self.port)
+        return self.port
+
+    def stop(self):
+        """Stop serving and close the pseudo-terminal"""
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+
+    @property
+    def byte_time(self):
+        """Time in seconds to transfer one byte (start bit, 8 data bits, stop bit)"""
+        return 10.0 / self.baudrate if self.baudrate else 0.0
+
+    def moving(self):
+        """True if any channel has not reached its target"""
+        with self.lock:
+            return any(self.targets[ch] and self.positions[ch] != self.targets[ch] for ch in range(self.channels))
+
+    def _run(self):
+        packet = bytearray()
+        rxClock = 0.0  # time at which the last byte received has completely arrived
+        nextUpdate = monotonic() + UPDATE_PERIOD
+        while self._running:
+            now = monotonic()
+            while now >= nextUpdate:
+                self._update()
+                nextUpdate += UPDATE_PERIOD
+            readable, _, _ = select.select([self._master], [], [], min(nextUpdate - now, UPDATE_PERIOD))
+            if not readable:
+                continue
+            try:
+                data = os.read(self._master, 1024)
+            except OSError:
+                continue
+            rxClock = max(rxClock, monotonic())
+            for byte in data:
+                rxClock += self.byte_time
+                packet.append(byte)
+                if self._complete(packet):
+                    delay = rxClock - monotonic()
+                    if delay > 0:
+                        sleep(delay)
+                    self._execute(packet)
+                    del packet[:]
+
+    def _complete(self, packet):
+        """Check the packet received so far, drop what cannot be a command
+        @return True if the packet holds one whole command
+        """
+        if packet[-1] & 0x80 and len(packet) > 1:
+            if packet[:-1] == bytes([_INIT_CMD]):
+                # a lone 0xAA is the baud rate detection byte
+                pass
+            else:
+                self._protocol_error()
+            del packet[:-1]
+        if not packet[0] & 0x80:
+            self._protocol_error()
+            del packet[:]
+            return False
+
+        if packet[0] == _INIT_CMD:
+            if len(packet) < 3:
+                return False
+            command = packet[2] | 0x80
+            data = packet[3:]
+        else:
+            command = packet[0]
+            data = packet[1:]
+        if command not in _DATA_SIZE:
+            self._protocol_error()
+            del packet[:]
+            return False
+        size = _DATA_SIZE[command]
+        if size is None:
+            size = 2 + 2 * data[0] if data else 1
+        return len(data) >= size
+
+    def _protocol_error(self):
+        with self.lock:
+            self.errors |= SERIAL_PROTOCOL_ERROR
+
+    def _execute(self, packet):
+        if packet[0] == _INIT_CMD:
+            if packet[1] != self.device:
+                return
+            command = packet[2] | 0x80
+            data = packet[3:]
+        else:
+            command = packet[0]
+            data = packet[1:]
+
+        reply = None
+        with self.lock:
+            if command == _SET_TARGET_CMD:
+                self._set_target(data[0], data[1] | data[2] << 7)
+            elif command == _SET_MULTIPLE_TARGET_CMD:
+                for i in range(data[0]):
+                    self._set_target(data[1] + i, data[2 + 2 * i] | data[3 + 2 * i] << 7)
+            elif command == _SET_SPEED_CMD:
+                if self._valid(data[0]):
+                    self.speeds[data[0]] = data[1] | data[2] << 7
+            elif command == _SET_ACCELERATION_CMD:
+                if self._valid(data[0]):
+                    self.accelerations[data[0]] = data[1] | data[2] << 7
+            elif command == _SET_PWM_CMD:
+                self.pwm = (data[0] | data[1] << 7, data[2] | data[3] << 7)
+            elif command == _GO_HOME_CMD:
+                for channel in range(self.channels):
+                    self._set_target(channel, self.home[channel])
+            elif command == _GET_POSITION_CMD:
+                position = int(self.positions[data[0]]) if self._valid(data[0]) else 0
+                reply = bytes([position & 0xff, position >> 8])
+            elif command == _GET_MOVING_STATE_CMD:
+                reply = bytes([int(any(self.targets[ch] and self.positions[ch] != self.targets[ch]
+                                       for ch in range(self.channels)))])
+            elif command == _GET_ERRORS_CMD:
+                reply = bytes([self.errors & 0xff, self.errors >> 8])
+                self.errors = 0
+
+        if reply is not None:
+            sleep(len(reply) * self.byte_time)
+            os.write(self._master, reply)
+
+    def _valid(self, channel):
+        if channel < self.channels:
+            return True
+        self.errors |= SERIAL_PROTOCOL_ERROR
+        return False
+
+    def _set_target(self, channel, target):
+        if not self._valid(channel):
+            return
+        self.targets[channel] = target
+        if not target or not self.positions[channel]:
+            # pulses stop, or start right at the target
+            self.positions[channel] = float(target)
+            self.velocities[channel] = 0.0
+
+    def _update(self):
+        """Move every channel by one 10 ms update"""
+        with self.lock:
+            for channel in range(self.channels):
+                target = self.targets[channel]
+                position = self.positions[channel]
+                if position == target:
+                    continue
+                speed = self.speeds[channel]
+                rate = self.accelerations[channel] / 8.0
+                distance = target - position
+                direction = 1.0 if distance > 0 else -1.0
+                velocity = self.velocities[channel] * direction  # positive towards the target
+                if not speed and not rate:
+                    self.positions[channel] = float(target)
+                    self.velocities[channel] = 0.0
+                    continue
+                if rate:
+                    # accelerate, but never faster than what still allows to stop at the target
+                    velocity = min(velocity + rate, sqrt(2 * rate * abs(distance)) + rate / 2)
+                    if speed:
+                        velocity = min(velocity, speed)
+                else:
+                    velocity = speed
+                if velocity >= abs(distance):
+                    self.positions[channel] = float(target)
+                    self.velocities[channel] = 0.0
+                else:
+                    self.positions[channel] = position + direction * velocity
+                    self.velocities[channel] = direction * velocity
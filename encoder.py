@@ -0,0 +1,186 @@
+# coding: utf-8
+"""
+@namespace maestro
+Encoding of the Maestro serial commands.
+
+An Encoder writes every command into one buffer allocated with it and returns a memoryview of the
+bytes, so no object is allocated per command. The view is only valid until the next command is
+encoded: write or copy it right away.
+
+Two framings exist (https://www.pololu.com/docs/0J40/5.c):
+    compact  the command byte followed by its data, answered by every device on the line
+    pololu   0xAA, the device number and the command byte with bit 7 cleared, then the data
+"""
+from struct import Struct
+
+COMPACT = 'compact'
+POLOLU = 'pololu'
+
+_DEVICE = 0x0c  # type: int
+_SET_MULTIPLE_TARGET_CMD = 0x9F  # type: int
+_SET_ACCELERATION_CMD = 0x89  # type: int
+_GET_MOVING_STATE_CMD = 0x93  # type: int
+_GET_POSITION_CMD = 0x90  # type: int
+_SET_TARGET_CMD = 0x84  # type: int
+_GET_ERRORS_CMD = 0xA1  # type: int
+_SET_SPEED_CMD = 0x87  # type: int
+_SET_PWM_CMD = 0x8A  # type: int
+_GO_HOME_CMD = 0xA2  # type: int
+_INIT_CMD = 0xAA  # type: int
+
+_BYTE = Struct('B')
+_CHANNEL_WORD = Struct('3B')  # channel, low 7 bits, high 7 bits
+_WORD = Struct('2B')
+_TWO_WORDS = Struct('4B')
+
+
+def contiguous_runs(targets):
+    """Split a {channel: target} dict into runs of consecutive channels
+    @param[in] targets A dict {channel: target}
+    @return A list of (first channel, [targets]) tuples sorted by channel
+    """
+    runs = []
+    last = None
+    for channel in sorted(targets):
+        if last is not None and channel == last + 1:
+            runs[-1][1].append(targets[channel])
+        else:
+            runs.append((channel, [targets[channel]]))
+        last = channel
+    return runs
+
+
+class Encoder:
+    """Encodes commands in one framing into a preallocated buffer"""
+
+    def __init__(self, protocol=COMPACT, device=_DEVICE, channels=24):
+        """Class constructor block
+
+        @param protocol COMPACT or POLOLU (default: COMPACT)
+        @param device The device number used by the Pololu framing (default: 0x0c)
+        @param channels The number of channels the buffer is sized for, it grows if needed (default: 24)
+        @return New Encoder object
+        """
+        if protocol not in (COMPACT, POLOLU):
+            raise ValueError('unknown protocol {}'.format(protocol))
+        self.protocol = protocol
+        self.device = device
+        self._pololu = protocol == POLOLU
+        self._headerSize = 3 if self._pololu else 1
+        self._buffer = None
+        self._reserve(8 * channels)
+
+    def _reserve(self, size):
+        if self._buffer is not None and len(self._buffer) >= size:
+            return
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+
+    def _header(self, offset, command):
+        """Write the framing of command at offset
+        @return The offset of the data
+        """
+        buf = self._buffer
+        if self._pololu:
+            buf[offset] = _INIT_CMD
+            buf[offset + 1] = self.device
+            buf[offset + 2] = command & 0x7F
+            return offset + 3
+        buf[offset] = command
+        return offset + 1
+
+    def _channel_word(self, command, channel, value):
+        offset = self._header(0, command)
+        _CHANNEL_WORD.pack_into(self._buffer, offset, channel, value & 0x7F, (value >> 7) & 0x7F)
+        return self._view[:offset + 3]
+
+    def _simple(self, command):
+        return self._view[:self._header(0, command)]
+
+    def set_target(self, channel, target):
+        """Set Target (0x84)"""
+        return self._channel_word(_SET_TARGET_CMD, channel, target)
+
+    def set_speed(self, channel, speed):
+        """Set Speed (0x87)"""
+        return self._channel_word(_SET_SPEED_CMD, channel, speed)
+
+    def set_acceleration(self, channel, acceleration):
+        """Set Acceleration (0x89)"""
+        return self._channel_word(_SET_ACCELERATION_CMD, channel, acceleration)
+
+    def set_PWM(self, onTime, period):
+        """Set PWM (0x8A)"""
+        offset = self._header(0, _SET_PWM_CMD)
+        _TWO_WORDS.pack_into(self._buffer, offset, onTime & 0x7F, (onTime >> 7) & 0x7F,
+                             period & 0x7F, (period >> 7) & 0x7F)
+        return self._view[:offset + 4]
+
+    def set_targets(self, targets):
+        """Set Multiple Targets (0x9F) for each run of consecutive channels, Set Target for single channels
+        @param[in] targets A dict {channel: target}
+        """
+        runs = contiguous_runs(targets)
+        self._reserve((self._headerSize + 2) * len(runs) + 2 * len(targets))
+        buf = self._buffer
+        offset = 0
+        for first, run in runs:
+            if len(run) == 1:
+                offset = self._header(offset, _SET_TARGET_CMD)
+                buf[offset] = first
+                offset += 1
+            else:
+                offset = self._header(offset, _SET_MULTIPLE_TARGET_CMD)
+                _WORD.pack_into(buf, offset, len(run), first)
+                offset += 2
+            for target in run:
+                _WORD.pack_into(buf, offset, target & 0x7F, (target >> 7) & 0x7F)
+                offset += 2
+        return self._view[:offset]
+
+    def targets_layout(self, channels):
+        """Layout of the set_targets packets of a fixed set of channels, to fill them without encoding
+        @param[in] channels A sequence of distinct channels
+        @return (template, offsets): the packets with every target 0 as a bytearray, and for each channel
+        of channels in the same order the offset of its low target byte, the high one follows
+        """
+        template = bytearray(self.set_targets(dict.fromkeys(channels, 0)))
+        position = {}
+        offset = 0
+        for first, run in contiguous_runs(dict.fromkeys(channels, 0)):
+            offset += self._headerSize + (1 if len(run) == 1 else 2)
+            for channel in range(first, first + len(run)):
+                position[channel] = offset
+                offset += 2
+        return template, [position[channel] for channel in channels]
+
+    def go_home(self):
+        """Go Home (0xA2)"""
+        return self._simple(_GO_HOME_CMD)
+
+    def get_position(self, channel):
+        """Get Position (0x90), answered by 2 bytes"""
+        offset = self._header(0, _GET_POSITION_CMD)
+        _BYTE.pack_into(self._buffer, offset, channel)
+        return self._view[:offset + 1]
+
+    def get_positions(self, channels):
+        """Get Position (0x90) for each channel, answered by 2 bytes per channel
+        @param[in] channels A sequence of channels
+        """
+        size = self._headerSize + 1
+        self._reserve(size * len(channels))
+        offset = 0
+        for channel in channels:
+            offset = self._header(offset, _GET_POSITION_CMD)
+            self._buffer[offset] = channel
+            offset += 1
+        return self._view[:offset]
+
+    def get_moving_state(self):
+        """Get Moving State (0x93), answered by 1 byte"""
+        return self._simple(_GET_MOVING_STATE_CMD)
+
+    def get_errors(self):
+        """Get Errors (0xA1), answered by 2 bytes"""
+        return self._simple(_GET_ERRORS_CMD)
@@ -0,0 +1,171 @@
+# coding: utf-8
+"""
+@namespace maestro
+Host side model of the Maestro servo motion.
+
+The Maestro updates its outputs every 10 ms. Speed limits are in (0.25 us)/(10 ms) and acceleration
+limits in (0.25 us)/(10 ms)/(80 ms), so each update the speed changes by acceleration / 8. With both
+limits a move is a trapezoid: the speed ramps up to the limit, stays there and ramps down symmetrically
+as the position approaches the target. A limit of 0 means no limit.
+
+The model only knows what the driver sent. A new target given during a move starts from the estimated
+position at rest, while the device keeps its current speed, so estimates are approximate and callers
+confirm the end of a move with the device.
+"""
+from math import ceil, sqrt
+from time import monotonic
+
+# Period of the Maestro output updates in seconds
+UPDATE_PERIOD = 0.01  # type: float
+
+
+def _profile(distance, speed, acceleration):
+    """Shape of a move from rest to rest
+    @param[in] distance The absolute distance in quarter-microseconds
+    @param[in] speed The speed limit, 0 for no limit
+    @param[in] acceleration The acceleration limit, 0 for no limit
+    @return (peak speed per update, speed change per update, number of updates)
+    """
+    if not distance or (not speed and not acceleration):
+        return 0, 0, 0
+    if not acceleration:
+        return speed, 0, distance / speed
+    rate = acceleration / 8.0
+    peak = sqrt(distance * rate)
+    if speed and speed < peak:
+        peak = speed
+    return peak, rate, peak / rate + distance / peak
+
+
+def _travelled(distance, peak, rate, ticks, elapsed):
+    """Distance covered after elapsed updates of a move shaped by _profile"""
+    if elapsed >= ticks:
+        return distance
+    if not rate:
+        return peak * elapsed
+    ramp = peak / rate
+    if elapsed <= ramp:
+        return rate * elapsed * elapsed / 2
+    if elapsed <= ticks - ramp:
+        return peak * ramp / 2 + peak * (elapsed - ramp)
+    left = ticks - elapsed
+    return distance - rate * left * left / 2
+
+
+def move_time(start, target, speed, acceleration):
+    """Time the Maestro takes to move from start to target at rest
+    @param[in] start The start position in quarter-microseconds
+    @param[in] target The target in quarter-microseconds
+    @param[in] speed The speed limit in (0.25 us)/(10 ms), 0 for no limit
+    @param[in] acceleration The acceleration limit in (0.25 us)/(10 ms)/(80 ms), 0 for no limit
+    @return The duration in seconds, rounded up to the next output update
+    """
+    peak, rate, ticks = _profile(abs(target - start), speed, acceleration)
+    return ceil(ticks) * UPDATE_PERIOD
+
+
+class MotionModel:
+    """Tracks the moves sent to each channel to predict positions and arrival times"""
+
+    def __init__(self):
+        # channel -> (start, target, speed, acceleration, start time, duration); start is None if unknown
+        self._moves = {}
+
+    def forget(self, channel=None):
+        """Forget what is known about channel, or about all channels if None"""
+        if channel is None:
+            self._moves.clear()
+        else:
+            self._moves.pop(channel, None)
+
+    def position(self, channel, now=None):
+        """Estimated position of channel
+        @param[in] channel The channel
+        @param[in] now The monotonic time of the estimate, the current time if None
+        @return The position in quarter-microseconds, None if unknown
+        """
+        move = self._moves.get(channel)
+        if move is None:
+            return None
+        start, target, speed, acceleration, began, duration = move
+        if now is None:
+            now = monotonic()
+        if duration is not None and now - began >= duration:
+            return target
+        if start is None:
+            return None
+        distance = abs(target - start)
+        peak, rate, ticks = _profile(distance, speed, acceleration)
+        travelled = _travelled(distance, peak, rate, ticks, (now - began) / UPDATE_PERIOD)
+        return start + travelled if target >= start else start - travelled
+
+    def move(self, channel, target, speed, acceleration, now=None):
+        """Record a new target or new limits for channel
+        @param[in] channel The channel
+        @param[in] target The target in quarter-microseconds
+        @param[in] speed The speed limit in effect, None if unknown
+        @param[in] acceleration The acceleration limit in effect, None if unknown
+        @param[in] now The monotonic time the command was sent, the current time if None
+        """
+        if now is None:
+            now = monotonic()
+        start = self.position(channel, now)
+        duration = None
+        if not target or start == 0:
+            # a target of 0 stops the pulses and pulses start right at the target
+            duration = 0.0
+        elif speed is None or acceleration is None:
+            pass
+        elif not speed and not acceleration:
+            duration = 0.0
+        elif start is not None:
+            duration = move_time(start, target, speed, acceleration)
+        self._moves[channel] = (start, target, speed, acceleration, now, duration)
+
+    def observe(self, channel, position, now=None):
+        """Record a position read from the device
+        @brief If the channel has not reached its target the move is assumed to continue from position.
+        """
+        if now is None:
+            now = monotonic()
+        move = self._moves.get(channel, (position, position, None, None, now, 0.0))
+        target, speed, acceleration = move[1:4]
+        # restart the move from the observed position, at rest
+        self._moves[channel] = (position, position, speed, acceleration, now, 0.0)
+        if position != target:
+            self.move(channel, target, speed, acceleration, now)
+
+    def arrival(self, channel=None):
+        """Predicted monotonic time at which channel, or every tracked channel if None, reaches its target
+        @return The time, None if it cannot be predicted
+        """
+        channels = self._moves if channel is None else (channel,)
+        latest = 0.0
+        for ch in channels:
+            move = self._moves.get(ch)
+            if move is None or move[5] is None:
+                return None
+            latest = max(latest, move[4] + move[5])
+        return latest
+
+    def estimate_move_time(self, channel, target, speed, acceleration, now=None):
+        """Time a move of channel to target would take if it was sent now
+        @param[in] channel The channel
+        @param[in] target The target in quarter-microseconds
+        @param[in] speed The speed limit, None if unknown
+        @param[in] acceleration The acceleration limit, None if unknown
+        @return The duration in seconds, None if it cannot be predicted
+        """
+        if not target:
+            # pulses stop at once, see move
+            return 0.0
+        if speed is None or acceleration is None:
+            return None
+        if not speed and not acceleration:
+            return 0.0
+        start = self.position(channel, now)
+        if start is None:
+            return None
+        if not start:
+            return 0.0
+        return move_time(start, target, speed, acceleration)
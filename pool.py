@@ -0,0 +1,258 @@
+# coding: utf-8
+"""
+@namespace maestro
+Several Maestros driven as one set of channels.
+
+A MaestroPool numbers the channels of all its controllers globally, in the order the controllers are
+given, and maps each global channel to its port, device number and local channel. Controllers on the
+same port are daisy chained and addressed with the Pololu protocol. Every port has its own writer thread,
+so the ports are driven in parallel; the commands of one call, or of one frame, for all the devices of a
+port are sent with a single write.
+
+    pool = MaestroPool([('/dev/ttyACM0', 12, 24), ('/dev/ttyACM1', 12, 24), ('/dev/ttyACM1', 13, 24)])
+    pool.set_targets({channel: 6000 for channel in range(72)})
+"""
+import logging
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from .driver import Maestro
+from .encoder import COMPACT, POLOLU
+
+logger = logging.getLogger(__name__)
+
+
+class _Port:
+    """The devices on one serial port and the thread writing to it"""
+
+    def __init__(self, name):
+        self.name = name
+        self.devices = []
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='maestro-pool')
+
+    def send(self, calls):
+        """Apply the calls, (maestro, method name, arguments), and send their commands with one write
+        @brief Every device of the batch records its commands as sent only if that write succeeds.
+        """
+        buf = bytearray()
+        committed = []
+        try:
+            for maestro, name, args in calls:
+                maestro.begin()
+                try:
+                    getattr(maestro, name)(*args)
+                except BaseException:
+                    maestro.abort()
+                    raise
+                if maestro.commit(into=buf):
+                    committed.append(maestro)
+            written = self.devices[0].write(buf) if buf else True
+        except BaseException:
+            for maestro in committed:
+                maestro.confirm(False)
+            raise
+        for maestro in committed:
+            maestro.confirm(written)
+        return written
+
+
+class MaestroPool:
+    """Global channel numbering and parallel I/O over several Maestros"""
+
+    def __init__(self, controllers, baudrate=9600, protocol=None):
+        """Class constructor block
+
+        @param controllers A list of (port, device number, number of channels), global channels are numbered
+                           in this order
+        @param baudrate The baudrate of the ports (default: 9600)
+        @param protocol The framing, COMPACT or POLOLU. By default COMPACT on the ports with one device and
+                        POLOLU on the daisy chains (default: None)
+        @return New MaestroPool object
+        """
+        self._ports = {}
+        self._controllers = []
+        self._channels = []  # global channel -> (port, maestro, local channel)
+        self._pending = {}  # port -> calls waiting for commit
+        self._frameDepth = 0
+
+        devices = {}
+        for port, device, channels in controllers:
+            devices.setdefault(port, []).append(device)
+        try:
+            for port, device, channels in controllers:
+                framing = protocol or (POLOLU if len(devices[port]) > 1 else COMPACT)
+                if framing == COMPACT and len(devices[port]) > 1:
+                    raise ValueError('the devices of {} share the line, they need the Pololu protocol'.format(port))
+                entry = self._ports.get(port)
+                if entry is None:
+                    entry = self._ports[port] = _Port(port)
+                # the devices of a port share its handle, see ports
+                maestro = Maestro(port=port, baudrate=baudrate, protocol=framing, device=device)
+                entry.devices.append(maestro)
+                self._controllers.append((entry, maestro))
+                for local in range(channels):
+                    self._channels.append((entry, maestro, local))
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self._channels)
+
+    @property
+    def controllers(self):
+        """The Maestros of the pool, in the order given"""
+        return [maestro for port, maestro in self._controllers]
+
+    def locate(self, channel):
+        """Where a global channel is
+        @param[in] channel The global channel
+        @return (port, device number, local channel)
+        """
+        port, maestro, local = self._channels[channel]
+        return port.name, maestro.encoder.device, local
+
+    def close(self):
+        """Stop the writer threads and close the ports"""
+        for port in self._ports.values():
+            port.executor.shutdown()
+            for maestro in reversed(port.devices):
+                maestro.close()
+        self._ports = {}
+
+    def _run(self, jobs):
+        """Run one job per port in parallel
+        @param[in] jobs A dict {port: callable}
+        @return A dict {port: result}
+        """
+        futures = {port: port.executor.submit(job) for port, job in jobs.items()}
+        return {port: future.result() for port, future in futures.items()}
+
+    def _call(self, port, maestro, name, *args):
+        self._pending.setdefault(port, []).append((maestro, name, args))
+        if self._frameDepth:
+            return True
+        return self._send()
+
+    def _send(self):
+        pending, self._pending = self._pending, {}
+        results = self._run({port: lambda port=port, calls=calls: port.send(calls)
+                             for port, calls in pending.items()})
+        return all(results.values())
+
+    def begin(self):
+        """Start a frame, see Maestro.begin: the commands are sent at the outermost commit, one write per port"""
+        self._frameDepth += 1
+
+    def commit(self):
+        """End a frame and send the commands of each port with one write, the ports in parallel
+        @return True if all writes were successful, False otherwise
+        """
+        if not self._frameDepth:
+            raise RuntimeError('commit without begin')
+        self._frameDepth -= 1
+        if self._frameDepth:
+            return True
+        return self._send()
+
+    def abort(self):
+        """Leave all frames and drop the commands buffered in them"""
+        self._frameDepth = 0
+        self._pending = {}
+
+    @contextmanager
+    def frame(self):
+        """Context manager around begin/commit, the commands are dropped if the block raises"""
+        self.begin()
+        try:
+            yield self
+        except BaseException:
+            self.abort()
+            raise
+        self.commit()
+
+    def set_target(self, channel, target, speed=None, acceleration=None):
+        """Sends a set target command to a global channel, see Maestro.set_target
+        @return True if the target write was successful, False otherwise
+        """
+        port, maestro, local = self._channels[channel]
+        return self._call(port, maestro, 'set_target', local, target, speed, acceleration)
+
+    def set_targets(self, targets):
+        """Sets the targets of any number of global channels, see Maestro.set_targets
+        @param[in] targets A dict {global channel: target}
+        @return True if all targets were written successfully, False otherwise
+        """
+        grouped = {}
+        for channel, target in targets.items():
+            port, maestro, local = self._channels[channel]
+            grouped.setdefault((port, maestro), {})[local] = target
+        self.begin()
+        for (port, maestro), local in grouped.items():
+            self._call(port, maestro, 'set_targets', local)
+        return self.commit()
+
+    def set_speed(self, channel, speed):
+        """Sends the speed command to a global channel, see Maestro.set_speed"""
+        port, maestro, local = self._channels[channel]
+        return self._call(port, maestro, 'set_speed', local, speed)
+
+    def set_acceleration(self, channel, acceleration):
+        """Sets the acceleration limit of a global channel, see Maestro.set_acceleration"""
+        port, maestro, local = self._channels[channel]
+        return self._call(port, maestro, 'set_acceleration', local, acceleration)
+
+    def go_home(self):
+        """Returns all servos of all controllers back to home position"""
+        self.begin()
+        for port, maestro in self._controllers:
+            self._call(port, maestro, 'go_home')
+        return self.commit()
+
+    def get_positions(self, channels, timeout=None):
+        """Returns the positions of global channels, one round trip per device, the ports in parallel
+        @param[in] channels An iterable of global channels
+        @param[in] timeout The read timeout in seconds of each device, the port timeout if None
+        @return array('H') of the positions in the order of channels, None if a write failed
+        @throws ReadError if a reply is incomplete
+        """
+        channels = list(channels)
+        requests = {}  # port -> {maestro: [(index in channels, local channel)]}
+        for index, channel in enumerate(channels):
+            port, maestro, local = self._channels[channel]
+            requests.setdefault(port, {}).setdefault(maestro, []).append((index, local))
+
+        def job(devices):
+            return [(slots, maestro.get_positions([local for index, local in slots], timeout))
+                    for maestro, slots in devices.items()]
+
+        positions = array('H', bytes(2 * len(channels)))
+        for replies in self._run({port: lambda devices=devices: job(devices)
+                                  for port, devices in requests.items()}).values():
+            for slots, values in replies:
+                if values is None:
+                    return None
+                for (index, local), value in zip(slots, values):
+                    positions[index] = value
+        return positions
+
+    def get_errors(self):
+        """Returns the errors of every controller, see Maestro.get_errors
+        @return A list of the error codes in the order of the controllers
+        """
+        results = self._run({port: lambda port=port: [maestro.get_errors() for maestro in port.devices]
+                             for port in self._ports.values()})
+        errors = {maestro: error for port in results for maestro, error in zip(port.devices, results[port])}
+        return [errors[maestro] for port, maestro in self._controllers]
+
+    def wait_until_at_target(self):
+        """Wait until no servo of any controller is moving any more, the ports in parallel"""
+        self._run({port: lambda port=port: [maestro.wait_until_at_target() for maestro in port.devices]
+                   for port in self._ports.values()})
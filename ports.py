@@ -0,0 +1,87 @@
+# coding: utf-8
+"""
+@namespace maestro
+Registry of the open serial ports, shared by all the Maestros of a process.
+
+The first acquire of a port opens it once, already configured, and sends the baud rate detection byte
+unless told not to, see Maestro.negotiate_baudrate;
+the next ones return the same handle and count the reference. The port is closed when the last user
+releases it, so any number of Maestros, e.g. daisy chained devices, share one handle. Its users take the
+lock of the handle around each write and each request with its reply, so that Maestros sharing it from
+different threads neither interleave their commands nor read each other's replies.
+"""
+import logging
+import threading
+import weakref
+
+import serial
+
+from .encoder import _INIT_CMD
+
+logger = logging.getLogger(__name__)
+
+TIMEOUT = 3  # seconds, read timeout of the ports
+WRITE_TIMEOUT = 0.5  # seconds
+
+_lock = threading.Lock()
+_ports = {}  # name -> [handle, number of users]
+_locks = weakref.WeakKeyDictionary()  # handle -> lock of its I/O
+
+
+def acquire(port, baudrate=9600, detect=True):
+    """Open a port or share the handle already open
+    @param[in] port The name of the port
+    @param[in] baudrate The baud rate, it must match the one of the handle if the port is open
+    @param[in] detect Send the baud rate detection byte 0xAA if the port is opened
+    @return The serial.Serial handle
+    @throws serial.SerialException if the port cannot be opened
+    @throws ValueError if the port is open at another baud rate
+    """
+    with _lock:
+        entry = _ports.get(port)
+        if entry is not None:
+            if entry[0].baudrate != baudrate:
+                raise ValueError('{} is open at {} baud, not {}'.format(port, entry[0].baudrate, baudrate))
+            entry[1] += 1
+            return entry[0]
+        handle = serial.Serial(port=port, baudrate=baudrate, timeout=TIMEOUT, write_timeout=WRITE_TIMEOUT)
+        if detect:
+            handle.write(bytes([_INIT_CMD]))
+            handle.flush()
+        _ports[port] = [handle, 1]
+        logger.info("Opened port %s at %d baud", port, baudrate)
+        return handle
+
+
+def release(handle):
+    """Give back a handle from acquire, the port is closed with its last user"""
+    with _lock:
+        entry = _ports.get(handle.port)
+        if entry is None or entry[0] is not handle:
+            return
+        entry[1] -= 1
+        if entry[1]:
+            return
+        del _ports[handle.port]
+    if handle.isOpen():
+        logger.info("Closing port %s", handle.port)
+        handle.close()
+
+
+def users(port):
+    """The number of users of a port, 0 if it is not open"""
+    with _lock:
+        entry = _ports.get(port)
+        return entry[1] if entry is not None else 0
+
+
+def lock(handle):
+    """The lock serializing the I/O of a handle, the same for all its users
+    @param[in] handle A handle from acquire, or any serial port object
+    @return A threading.RLock
+    """
+    with _lock:
+        entry = _locks.get(handle)
+        if entry is None:
+            entry = _locks[handle] = threading.RLock()
+        return entry
@@ -0,0 +1,125 @@
+# coding: utf-8
+"""
+@namespace maestro
+I/O statistics of a Maestro, see Maestro.enable_stats.
+
+The counters are plain integers and the latency histograms have fixed buckets, so recording costs a
+few additions and one bisect. A Maestro without statistics only tests one attribute against None.
+"""
+from bisect import bisect_left
+
+# Upper bounds in seconds of the latency buckets, the last bucket holds everything slower
+BUCKETS = (50e-6, 100e-6, 200e-6, 500e-6, 1e-3, 2e-3, 5e-3, 10e-3, 20e-3, 50e-3, 100e-3, 200e-3, 500e-3, 1.0)
+
+
+class Histogram:
+    """Latency histogram with the fixed buckets of BUCKETS"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the q-th percentile
+        @param[in] q The percentile, 0 to 100
+        @return Seconds, max for the last bucket, 0.0 if empty
+        """
+        if not self.count:
+            return 0.0
+        rank = q / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count, 'mean': self.mean, 'max': self.max, 'p50': self.percentile(50),
+                'p99': self.percentile(99), 'buckets': list(self.counts)}
+
+
+class IOStats:
+    """Counters and latency histograms of the I/O of one Maestro"""
+
+    def __init__(self, hook=None):
+        """Class constructor block
+
+        @param hook A callable hook(event, seconds, size) called after every write, flush and query round
+                    trip. event is 'write', 'flush' or the name of the query, size the bytes written or read
+        @return New IOStats object
+        """
+        self.hook = hook
+        self.reset()
+
+    def reset(self):
+        """Set all counters to zero"""
+        self.commands = {}  # command name -> count
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.writes = 0
+        self.flushes = 0
+        self.reads = 0
+        self.read_timeouts = 0
+        self.latency = {}  # 'write', 'flush' or query name -> Histogram
+
+    @property
+    def syscalls(self):
+        """Writes, flushes and reads issued to the port"""
+        return self.writes + self.flushes + self.reads
+
+    def _latency(self, event, seconds, size):
+        histogram = self.latency.get(event)
+        if histogram is None:
+            histogram = self.latency[event] = Histogram()
+        histogram.add(seconds)
+        if self.hook is not None:
+            self.hook(event, seconds, size)
+
+    def command(self, name):
+        self.commands[name] = self.commands.get(name, 0) + 1
+
+    def write(self, seconds, size):
+        self.writes += 1
+        self.bytes_written += size
+        self._latency('write', seconds, size)
+
+    def flush(self, seconds):
+        self.flushes += 1
+        self._latency('flush', seconds, 0)
+
+    def read(self, size, expected):
+        self.reads += 1
+        self.bytes_read += size
+        if size < expected:
+            self.read_timeouts += 1
+
+    def query(self, name, seconds, size):
+        self._latency(name, seconds, size)
+
+    def snapshot(self):
+        """All counters as a dict, the histograms as dicts of count, mean, max, p50, p99 and buckets"""
+        return {
+            'commands': dict(self.commands),
+            'bytes_written': self.bytes_written,
+            'bytes_read': self.bytes_read,
+            'writes': self.writes,
+            'flushes': self.flushes,
+            'reads': self.reads,
+            'syscalls': self.syscalls,
+            'read_timeouts': self.read_timeouts,
+            'latency': {event: histogram.snapshot() for event, histogram in self.latency.items()},
+        }
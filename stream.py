@@ -0,0 +1,160 @@
+# coding: utf-8
+"""
+@namespace maestro
+Fixed rate streaming of trajectories to a Maestro.
+
+A TrajectoryStreamer sends one frame of targets per tick, all channels in a single write of Set Multiple
+Targets packets. The packet layout is computed once for the channels; a NumPy trajectory is then encoded
+for all ticks at once by splitting whole columns into their 7 bit halves, while frames coming from a
+generator are encoded as they arrive. Ticks follow absolute deadlines, so a late tick does not delay the
+next ones, and late ticks are counted in the returned StreamReport.
+
+    streamer = TrajectoryStreamer(servo, channels=range(18), rate=50)
+    report = streamer.run(trajectory)  # numpy array, time x channels, quarter-microseconds
+"""
+import logging
+from time import perf_counter, sleep
+
+try:
+    import numpy
+except ImportError:  # numpy is optional, generators of frames work without it
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+
+class StreamReport:
+    """Timing of a run of TrajectoryStreamer"""
+
+    def __init__(self):
+        self.ticks = 0  # frames written
+        self.missed = 0  # frames written later than the tolerance
+        self.skipped = 0  # frames dropped to catch up, see TrajectoryStreamer.skip_late
+        self.max_lateness = 0.0  # seconds
+        self.total_lateness = 0.0  # seconds
+        self.duration = 0.0  # seconds
+
+    @property
+    def mean_lateness(self):
+        return self.total_lateness / self.ticks if self.ticks else 0.0
+
+    def __repr__(self):
+        return 'StreamReport(ticks={}, missed={}, skipped={}, max_lateness={:.6f}, mean_lateness={:.6f})'.format(
+            self.ticks, self.missed, self.skipped, self.max_lateness, self.mean_lateness)
+
+
+class TrajectoryStreamer:
+    """Streams frames of targets of a fixed set of channels at a fixed rate"""
+
+    def __init__(self, servo, channels, rate=50.0, tolerance=None, skip_late=False):
+        """Class constructor block
+
+        @param servo The Maestro to write to
+        @param channels The channels of the columns of the frames, in the same order
+        @param rate The number of frames per second (default: 50)
+        @param tolerance A frame written later than this after its deadline is missed (default: half a period)
+        @param skip_late Drop the frames whose next frame is already due instead of sending them late (default: False)
+        @return New TrajectoryStreamer object
+        """
+        self.servo = servo
+        self.channels = list(channels)
+        if len(set(self.channels)) != len(self.channels):
+            raise ValueError('channels must be distinct')
+        self.period = 1.0 / rate
+        self.tolerance = self.period / 2 if tolerance is None else tolerance
+        self.skip_late = skip_late
+        self._running = False
+        self._template, offsets = servo.encoder.targets_layout(self.channels)
+        self._offsets = offsets
+        if numpy is not None:
+            self._lowColumns = numpy.array(offsets, dtype=numpy.intp)
+            self._highColumns = self._lowColumns + 1
+
+    def stop(self):
+        """Make run return after the current tick, may be called from another thread"""
+        self._running = False
+
+    def encode(self, frames):
+        """Encode a whole trajectory
+        @param[in] frames A NumPy array of targets, one row per tick and one column per channel
+        @return A uint8 array with the packets of one tick per row
+        """
+        frames = numpy.asarray(frames)
+        if frames.ndim != 2 or frames.shape[1] != len(self.channels):
+            raise ValueError('expected frames of shape (ticks, {})'.format(len(self.channels)))
+        frames = frames.astype(numpy.uint16, copy=False)
+        packets = numpy.empty((frames.shape[0], len(self._template)), dtype=numpy.uint8)
+        packets[:] = numpy.frombuffer(self._template, dtype=numpy.uint8)
+        packets[:, self._lowColumns] = frames & 0x7F
+        packets[:, self._highColumns] = (frames >> 7) & 0x7F
+        return packets
+
+    def encode_frame(self, frame, out=None):
+        """Encode a single frame
+        @param[in] frame A sequence of targets, one per channel
+        @param[in] out A bytearray from a previous call to reuse
+        @return The packets as a bytearray
+        """
+        if out is None:
+            out = bytearray(self._template)
+        for offset, target in zip(self._offsets, frame):
+            target = int(target)
+            out[offset] = target & 0x7F
+            out[offset + 1] = (target >> 7) & 0x7F
+        return out
+
+    def _packets(self, trajectory):
+        if numpy is not None and isinstance(trajectory, numpy.ndarray):
+            for row in self.encode(trajectory):
+                yield row.data
+        else:
+            out = bytearray(self._template)
+            for frame in trajectory:
+                yield self.encode_frame(frame, out)
+
+    def run(self, trajectory):
+        """Stream a trajectory, one frame per period, starting now
+        @param[in] trajectory A NumPy array (time x channels) or an iterable of frames of targets
+        @return A StreamReport of the timing
+        """
+        report = StreamReport()
+        servo = self.servo
+        period = self.period
+        self._running = True
+        start = perf_counter()
+        tick = 0
+        last = None  # the last packet written
+        try:
+            for packet in self._packets(trajectory):
+                if not self._running:
+                    break
+                deadline = start + tick * period
+                tick += 1
+                now = perf_counter()
+                if now < deadline:
+                    sleep(deadline - now)
+                elif self.skip_late and now - deadline >= period:
+                    report.skipped += 1
+                    continue
+                if not servo.write(packet):
+                    break
+                last = bytes(packet)
+                lateness = max(0.0, perf_counter() - deadline)
+                report.ticks += 1
+                report.total_lateness += lateness
+                if lateness > report.max_lateness:
+                    report.max_lateness = lateness
+                if lateness > self.tolerance:
+                    report.missed += 1
+        finally:
+            self._running = False
+            report.duration = perf_counter() - start
+            # the targets were written behind the shadow state and the replay record
+            for channel in self.channels:
+                servo.invalidate(channel)
+            if last is not None:
+                servo.record_targets({channel: last[offset] | last[offset + 1] << 7
+                                      for channel, offset in zip(self.channels, self._offsets)})
+        if report.missed:
+            logger.warning('%d of %d frames missed their deadline', report.missed, report.ticks)
+        return report
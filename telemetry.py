@@ -0,0 +1,257 @@
+# coding: utf-8
+"""
+@namespace maestro
+Telemetry of a Maestro recorded into a memory-mapped ring file, and its replay.
+
+A TelemetryRecorder samples the positions of a set of channels, and optionally the error flags, at a
+fixed rate. Every sample is one fixed-width record written in place into a file mapped in memory: the
+file is sized once for capacity records and the oldest records are overwritten, so a recording of any
+length keeps the same disk and memory footprint.
+
+File layout, little endian:
+    header   magic b'MAESTREC', version (H), number of channels (H), record size (I), capacity (Q),
+             rate (d), creation time (d), number of records written so far (Q), then the channels
+             one byte each, padded to a multiple of 8
+    records  capacity slots of: time.time() of the sample (d), errors (H), one position per channel (H),
+             padded to a multiple of 8. Record n is in slot n % capacity
+
+    with TelemetryRecorder(servo, 'run.rec', channels=range(6), rate=100, capacity=360000) as recorder:
+        recorder.run(duration=60)
+
+    log = TelemetryLog('run.rec')
+    records = log.records()  # numpy structured array with the fields time, errors and positions
+    log.replay(servo, speed=2.0)
+"""
+import logging
+import mmap
+import os
+import time
+from struct import Struct
+from time import perf_counter, sleep
+
+from .driver import ReadError
+
+try:
+    import numpy
+except ImportError:  # numpy is optional, TelemetryLog can be iterated without it
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'MAESTREC'
+VERSION = 1
+
+_HEADER = Struct('<8sHHIQddQ')
+_COUNT = Struct('<Q')
+_COUNT_OFFSET = _HEADER.size - _COUNT.size
+
+
+def _align(size):
+    return (size + 7) & ~7
+
+
+def _record_struct(channels):
+    size = 10 + 2 * channels
+    return Struct('<dH{}H{}x'.format(channels, _align(size) - size))
+
+
+class TelemetryRecorder:
+    """Samples positions and errors of a Maestro at a fixed rate into a ring file"""
+
+    def __init__(self, servo, path, channels, rate=100.0, capacity=100000, errors=True):
+        """Class constructor block
+
+        @param servo The Maestro to sample
+        @param path The file to record to, it is overwritten
+        @param channels The channels whose position is recorded, in the order of the records
+        @param rate The number of samples per second (default: 100)
+        @param capacity The number of records kept, the oldest are overwritten (default: 100000)
+        @param errors Also read the errors at every sample, one more round trip (default: True)
+        @return New TelemetryRecorder object, the file is created and mapped
+        """
+        self.servo = servo
+        self.channels = bytes(channels)
+        if not self.channels:
+            raise ValueError('no channels to record')
+        self.period = 1.0 / rate
+        self.capacity = capacity
+        self.errors = errors
+        self.count = 0
+        self.dropped = 0  # samples lost to incomplete replies
+        self._running = False
+        self._record = _record_struct(len(self.channels))
+        self._dataOffset = _align(_HEADER.size + len(self.channels))
+
+        with open(path, 'w+b') as f:
+            f.truncate(self._dataOffset + capacity * self._record.size)
+            self._map = mmap.mmap(f.fileno(), 0)
+        _HEADER.pack_into(self._map, 0, MAGIC, VERSION, len(self.channels), self._record.size, capacity,
+                          rate, time.time(), 0)
+        self._map[_HEADER.size:_HEADER.size + len(self.channels)] = self.channels
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Write the mapping back to the file and unmap it"""
+        if self._map is not None:
+            self._map.flush()
+            self._map.close()
+            self._map = None
+
+    def sample(self):
+        """Read the positions, and the errors if enabled, and append one record
+        @return True if recorded, False if the reply was incomplete or the write failed
+        """
+        servo = self.servo
+        stamp = time.time()
+        try:
+            positions = servo.get_positions(self.channels)
+            errors = servo.get_errors() if self.errors else (0, 0)
+        except ReadError as e:
+            logger.warning('telemetry sample dropped: %s', e)
+            positions = None
+        if not positions or not errors:
+            self.dropped += 1
+            return False
+        low, high = errors
+        offset = self._dataOffset + (self.count % self.capacity) * self._record.size
+        self._record.pack_into(self._map, offset, stamp, low | high << 8, *positions)
+        self.count += 1
+        # the count is updated last, a reader never sees a record before it is complete
+        _COUNT.pack_into(self._map, _COUNT_OFFSET, self.count)
+        return True
+
+    def stop(self):
+        """Make run return after the current sample, may be called from another thread"""
+        self._running = False
+
+    def run(self, duration=None):
+        """Sample at the rate until stop is called or for duration seconds
+        @brief Samples follow absolute deadlines, a sample later than a whole period is skipped.
+        @param[in] duration The time to record in seconds, until stop if None
+        @return The number of records written
+        """
+        period = self.period
+        start = perf_counter()
+        end = None if duration is None else start + duration
+        written = 0
+        tick = 0
+        self._running = True
+        try:
+            while self._running:
+                deadline = start + tick * period
+                if end is not None and deadline >= end:
+                    break
+                now = perf_counter()
+                if now < deadline:
+                    sleep(deadline - now)
+                elif now - deadline >= period:
+                    tick = int((now - start) / period)
+                    continue
+                tick += 1
+                written += self.sample()
+        finally:
+            self._running = False
+        return written
+
+
+class TelemetryLog:
+    """Reads a file written by TelemetryRecorder, also while it is being recorded"""
+
+    def __init__(self, path):
+        """Class constructor block
+
+        @param path The recorded file
+        @return New TelemetryLog object, the file is mapped read only
+        """
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, channels, recordSize, capacity, rate, created, count = _HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != VERSION:
+            self._map.close()
+            raise ValueError('{} is not a telemetry file'.format(os.fspath(path)))
+        self.channels = bytes(self._map[_HEADER.size:_HEADER.size + channels])
+        self.capacity = capacity
+        self.rate = rate
+        self.created = created
+        self._record = _record_struct(channels)
+        if self._record.size != recordSize:
+            self._map.close()
+            raise ValueError('unexpected record size {}'.format(recordSize))
+        self._dataOffset = _align(_HEADER.size + channels)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Unmap the file, the NumPy views must have been released"""
+        self._map.close()
+
+    @property
+    def count(self):
+        """The number of records written so far, including the ones overwritten"""
+        return _COUNT.unpack_from(self._map, _COUNT_OFFSET)[0]
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    @property
+    def dtype(self):
+        """NumPy dtype of a record: time (float64), errors (uint16) and positions (uint16, one per channel)"""
+        return numpy.dtype({'names': ['time', 'errors', 'positions'],
+                            'formats': ['<f8', '<u2', ('<u2', (len(self.channels),))],
+                            'offsets': [0, 8, 10], 'itemsize': self._record.size})
+
+    def views(self):
+        """The records in chronological order as read-only NumPy views of the file, without a copy
+        @return A tuple of one structured array, or of two once the ring has wrapped around
+        """
+        count = self.count
+        ring = numpy.frombuffer(self._map, dtype=self.dtype, count=self.capacity, offset=self._dataOffset)
+        if count <= self.capacity:
+            return ring[:count],
+        oldest = count % self.capacity
+        return ring[oldest:], ring[:oldest]
+
+    def records(self):
+        """The records in chronological order as one structured array, copied only if the ring wrapped"""
+        views = self.views()
+        return views[0] if len(views) == 1 else numpy.concatenate(views)
+
+    def __iter__(self):
+        """Yields (time, errors, positions) in chronological order, without NumPy"""
+        count = self.count
+        size = self._record.size
+        for n in range(max(0, count - self.capacity), count):
+            values = self._record.unpack_from(self._map, self._dataOffset + (n % self.capacity) * size)
+            yield values[0], values[1], values[2:]
+
+    def replay(self, servo, speed=1.0, channels=None):
+        """Send the recorded positions as targets with the recorded timing
+        @brief To replay without hardware open the Maestro on a MaestroEmulator port.
+        @param[in] servo The Maestro to send the targets to
+        @param[in] speed The time scale, 2.0 replays twice as fast (default: 1.0)
+        @param[in] channels Recorded channel -> channel to drive, the recorded channels if None
+        @return The number of records sent
+        """
+        targets = [channels[channel] if channels else channel for channel in self.channels]
+        start = perf_counter()
+        first = None
+        sent = 0
+        for stamp, errors, positions in self:
+            if first is None:
+                first = stamp
+            delay = start + (stamp - first) / speed - perf_counter()
+            if delay > 0:
+                sleep(delay)
+            if not servo.set_targets(dict(zip(targets, positions))):
+                break
+            sent += 1
+        return sent
@@ -0,0 +1,401 @@
+# coding: utf-8
+"""Driver paths checked against MaestroEmulator, without byte timing so they run quickly in CI"""
+import struct
+import threading
+from time import perf_counter, sleep
+
+import pytest
+import serial
+
+from .. import ports
+from ..calibration import Calibration, CalibrationTable
+from ..driver import InitError, Maestro, NotInitialized, NotWritable, ReadError
+from ..emulator import SERIAL_PROTOCOL_ERROR, MaestroEmulator
+from ..encoder import COMPACT, POLOLU, Encoder
+from ..kinematics import UPDATE_PERIOD
+from ..pool import MaestroPool
+from ..stream import TrajectoryStreamer
+from ..worker import IOWorker
+
+
+@pytest.fixture
+def emulator():
+    with MaestroEmulator(baudrate=None) as emulator:
+        yield emulator
+
+
+def settle():
+    """Let the emulator move the channels to targets sent without speed limit"""
+    sleep(3 * UPDATE_PERIOD)
+
+
+@pytest.fixture
+def servo(emulator):
+    servo = Maestro(port=emulator.port)
+    yield servo
+    servo.close()
+
+
+def test_calibration():
+    arm = Calibration(min=4200, max=7600, home=5900, invert=True)
+    assert [arm.percent(p) for p in (0, 100, -100, 50, 150)] == [5900, 4200, 7600, 5050, 4200]
+    assert [arm.angle(a) for a in (0, 90, -45)] == [5900, 4200, 6750]
+    curved = Calibration(curve=lambda fraction: fraction ** 3)
+    assert [curved.percent(p) for p in (50, -50, 100)] == [6250, 5750, 8000]
+    with pytest.raises(ValueError):
+        Calibration(min=5000, max=7000, home=8000)
+
+
+def test_calibration_tables():
+    pytest.importorskip('numpy')
+    arm = Calibration(min=4200, max=7600, home=5900, invert=True)
+    assert arm.percents([[0, 100], [-100, 50]]).tolist() == [[5900, 4200], [7600, 5050]]
+    assert arm.angles([90, -45]).tolist() == [4200, 6750]
+    table = CalibrationTable([Calibration(), arm])
+    assert table.percents([[0, 0], [100, 100], [-50, 25]]).tolist() == [[6000, 5900], [8000, 4200], [5000, 5475]]
+    assert table.angles([[45, 45]]).tolist() == [[7000, 5050]]
+    with pytest.raises(ValueError):
+        CalibrationTable([Calibration(), Calibration(resolution=4)])
+
+
+def test_framing():
+    assert bytes(Encoder(COMPACT).set_target(3, 6000)) == b'\x84\x03\x70\x2e'
+    assert bytes(Encoder(POLOLU, device=12).set_target(3, 6000)) == b'\xaa\x0c\x04\x03\x70\x2e'
+    assert bytes(Encoder(POLOLU, device=12).get_errors()) == b'\xaa\x0c\x21'
+
+
+@pytest.mark.parametrize('protocol', [COMPACT, POLOLU])
+def test_framing_on_the_device(emulator, protocol):
+    servo = Maestro(port=emulator.port, protocol=protocol)
+    other = Maestro(port=emulator.port, protocol=POLOLU, device=emulator.device + 1)
+    try:
+        servo.set_target(3, 7000)
+        other.set_target(4, 5000)  # not addressed to the emulator
+        assert servo.get_errors() == (0, 0)
+        assert emulator.targets[3:5] == [7000, 6000]
+    finally:
+        other.close()
+        servo.close()
+
+
+def record_writes(monkeypatch, servo):
+    """The list of the bytes of every write to the port of servo from now on"""
+    writes = []
+    write = servo._commandPort.write
+    monkeypatch.setattr(servo._commandPort, 'write', lambda data: writes.append(bytes(data)) or write(data))
+    return writes
+
+
+def test_frame_is_one_write(emulator, servo, monkeypatch):
+    writes = record_writes(monkeypatch, servo)
+    with servo.frame():
+        servo.set_speed(0, 10)
+        with servo.frame():
+            servo.set_target(0, 7000)
+            servo.set_target(1, 5000)
+        assert writes == []
+    assert writes == [b'\x87\x00\x0a\x00\x84\x00\x58\x36\x84\x01\x08\x27']
+    assert servo.get_errors() == (0, 0)
+    assert emulator.targets[:2] == [7000, 5000]
+
+
+def test_failed_inner_frame_drops_the_outer_one(emulator, servo):
+    servo.begin()
+    servo.set_target(0, 7000)
+    with pytest.raises(ZeroDivisionError):
+        with servo.frame():
+            servo.set_target(1, 5000)
+            1 / 0
+    servo.set_target(2, 7000)
+    assert servo.commit() is False
+    assert servo.get_errors() == (0, 0)
+    assert emulator.targets[:3] == [6000, 6000, 6000]
+    # the frames stayed balanced, so the next command is sent at once
+    assert servo.set_target(0, 7000)
+    assert servo.get_errors() == (0, 0)
+    assert emulator.targets[0] == 7000
+
+
+def test_shadow_skips_unchanged_values(emulator, monkeypatch):
+    servo = Maestro(port=emulator.port, shadow=True)
+    try:
+        writes = record_writes(monkeypatch, servo)
+        assert servo.set_target(0, 7000) and servo.set_target(0, 7000)
+        assert servo.set_speed(0, 10) and servo.set_speed(0, 10)
+        assert len(writes) == 2
+        servo.invalidate(0)
+        assert servo.set_target(0, 7000)
+        assert len(writes) == 3
+        # an error may have reset the device, get_errors forgets everything
+        servo.write(b'\x01\x02')
+        assert servo.get_errors() == (SERIAL_PROTOCOL_ERROR, 0)
+        del writes[:]
+        assert servo.set_target(0, 7000)
+        assert writes == [b'\x84\x00\x58\x36']
+    finally:
+        servo.close()
+
+
+def test_shadow_forgets_a_failed_write(emulator, monkeypatch):
+    servo = Maestro(port=emulator.port, shadow=True)
+    try:
+        def timeout(data):
+            raise serial.SerialTimeoutException('Write timeout')
+
+        with monkeypatch.context() as patch:
+            patch.setattr(servo._commandPort, 'write', timeout)
+            with pytest.raises(serial.SerialTimeoutException):
+                with servo.frame():
+                    servo.set_target(0, 7000)
+        assert servo.set_target(0, 7000)
+        assert servo.get_errors() == (0, 0)
+        assert emulator.targets[0] == 7000
+    finally:
+        servo.close()
+
+
+def test_set_targets_splits_contiguous_runs(emulator, servo):
+    targets = {0: 5000, 1: 5100, 2: 5200, 5: 7000}
+    assert bytes(servo.encoder.set_targets(targets)) == (b'\x9f\x03\x00\x08\x27\x6c\x27\x50\x28'
+                                                         b'\x84\x05\x58\x36')
+    servo.set_targets(targets)
+    settle()
+    assert list(servo.get_positions([0, 1, 2, 3, 4, 5])) == [5000, 5100, 5200, 6000, 6000, 7000]
+    assert servo.get_errors() == (0, 0)
+
+
+def test_get_positions_partial_reply(emulator, servo):
+    servo.set_target(0, 7000)
+    settle()
+    # channel 200 is not a valid data byte, the emulator drops that request as a protocol error
+    with pytest.raises(ReadError) as error:
+        servo.get_positions([0, 200], timeout=0.1)
+    assert error.value.data == b'\x58\x1b'
+    assert servo.get_errors() == (SERIAL_PROTOCOL_ERROR, 0)
+    assert list(servo.get_positions([1, 0])) == [6000, 7000]
+
+
+def test_get_positions_timeout(emulator, servo):
+    other = Maestro(port=emulator.port, protocol=POLOLU, device=emulator.device + 1)
+    try:
+        start = perf_counter()
+        with pytest.raises(ReadError) as error:
+            other.get_positions([0, 1], timeout=0.1)  # no device answers
+        assert 0.1 <= perf_counter() - start < 1
+        assert error.value.data == b''
+        assert servo._commandPort.timeout == ports.TIMEOUT
+    finally:
+        other.close()
+
+
+@pytest.mark.parametrize('speed, acceleration', [(40, 0), (40, 5)])
+def test_estimate_move_time(emulator, servo, speed, acceleration):
+    assert servo.estimate_move_time(0, 7000) is None  # nothing known of the channel yet
+    servo.set_speed(0, speed)
+    servo.set_acceleration(0, acceleration)
+    assert servo.get_position(0) == 6000
+    estimate = servo.estimate_move_time(0, 7000)
+    assert servo.estimate_move_time(0, 0) == 0.0
+    start = perf_counter()
+    servo.set_target(0, 7000)
+    while emulator.positions[0] != 7000:
+        sleep(0.002)
+    # the model ramps continuously where the device changes its speed once per update
+    assert abs(perf_counter() - start - estimate) < 0.1 * estimate + 2 * UPDATE_PERIOD
+
+
+def test_wait_until_at_target(emulator):
+    servo = Maestro(port=emulator.port)
+    servo.set_target(0, 7000, speed=100, wait=True)
+    assert emulator.positions[0] == 7000
+    servo.close()
+    with pytest.raises(NotWritable):
+        servo.wait_until_at_target()  # used to poll a closed port forever
+
+
+def test_stats(emulator, servo):
+    assert servo.stats() is None
+    events = []
+    servo.enable_stats(lambda event, seconds, size: events.append((event, size)))
+    with servo.frame():
+        servo.set_target(0, 7000)
+        servo.set_speed(1, 10)
+    servo.get_positions([0, 1])
+    with pytest.raises(ReadError):
+        servo.get_positions([0, 200], timeout=0.05)
+    stats = servo.stats()
+    assert stats['commands'] == {'set_target': 1, 'set_speed': 1, 'get_positions': 2}
+    assert (stats['writes'], stats['flushes'], stats['reads'], stats['syscalls']) == (3, 3, 2, 8)
+    assert (stats['bytes_written'], stats['bytes_read'], stats['read_timeouts']) == (16, 6, 1)
+    assert events == [('write', 8), ('flush', 0), ('write', 4), ('flush', 0), ('get_positions', 4),
+                      ('write', 4), ('flush', 0)]
+    latency = stats['latency']
+    assert (latency['write']['count'], latency['flush']['count'], latency['get_positions']['count']) == (3, 3, 1)
+    assert sum(latency['write']['buckets']) == 3
+    servo.disable_stats()
+    assert servo.stats() is None
+
+
+def test_set_target_percent_uses_the_calibration(emulator, servo):
+    servo.calibrate(0, Calibration(min=4200, max=7600, home=5900, invert=True))
+    assert servo.set_target_percent(0, 50)
+    assert servo.set_targets_percent({0: 100, 1: 50})
+    assert servo.get_errors() == (0, 0)
+    assert emulator.targets[:2] == [4200, servo.percent2command(50)]
+    servo.calibrate(0, None)
+    assert servo.calibration(0) is None
+
+
+def test_negotiate_baudrate(emulator):
+    servo = Maestro(port=emulator.port, detect_baud=False)
+    try:
+        assert servo.negotiate_baudrate([115200, 9600]) == 115200
+        assert servo._commandPort.baudrate == 115200
+        with pytest.raises(NotInitialized):
+            Maestro(port=emulator.port)  # the shared handle is at 115200 now
+        other = Maestro(port=emulator.port, baudrate=115200)
+        assert ports.users(emulator.port) == 2
+        other.close()
+        assert servo.get_errors() == (0, 0)
+    finally:
+        servo.close()
+    assert ports.users(emulator.port) == 0
+
+
+def test_negotiate_baudrate_without_answer(emulator):
+    servo = Maestro(port=emulator.port, protocol=POLOLU, device=emulator.device + 1, detect_baud=False)
+    try:
+        with pytest.raises(InitError):
+            servo.negotiate_baudrate([115200, 57600], timeout=0.02)
+        assert servo._commandPort.baudrate == 9600
+    finally:
+        servo.close()
+
+
+def test_protocol_error(emulator, servo):
+    servo.write(b'\x01\x02')
+    assert servo.get_errors() == (SERIAL_PROTOCOL_ERROR, 0)
+    assert servo.get_errors() == (0, 0)
+
+
+def test_worker_latest_target_wins(emulator, servo):
+    worker = IOWorker(servo)  # not started, so everything queued ends in one batch
+    worker.put('set_target', (0, 5000))
+    worker.put('set_speed', (1, 10))
+    worker.put('set_target', (0, 7000))
+    worker.put('set_targets', ({0: 6500, 1: 6600},))
+    assert len(worker._ops) == 3
+    worker.start()
+    worker.stop()
+    assert worker.batches == 1
+    assert servo.get_errors() == (0, 0)
+    assert emulator.targets[:2] == [6500, 6600]
+    assert emulator.speeds[1] == 10
+
+
+def test_worker_bad_argument_raises_for_its_caller(emulator):
+    servo = Maestro(port=emulator.port, threaded=True)
+    try:
+        with pytest.raises(struct.error):
+            servo.get_position(300)
+        with pytest.raises(struct.error):
+            servo.set_target(300, 6000)
+        servo.set_target(0, 7000)
+        assert servo.get_errors() == (0, 0)
+        settle()
+        assert servo.get_position(0) == 7000
+    finally:
+        servo.close()
+
+
+def test_resync_after_get_errors(emulator, servo):
+    servo.set_speed(0, 20)
+    servo.set_target(0, 7000)
+    servo.set_target(1, 5000)
+    servo.write(b'\x01\x02')
+    assert servo.get_errors() == (SERIAL_PROTOCOL_ERROR, 0)
+    with emulator.lock:
+        emulator.targets[:2] = [6000, 6000]
+        emulator.speeds[0] = 0
+    assert servo.resync() == (0, 0)
+    assert servo.get_errors() == (0, 0)
+    assert emulator.targets[:2] == [7000, 5000]
+    assert emulator.speeds[0] == 20
+
+
+def test_shared_port_from_threads(emulator, servo):
+    threaded = Maestro(port=emulator.port, threaded=True)
+    try:
+        servo.set_target(0, 7000)
+        threaded.set_target(1, 5000)
+        assert threaded.get_errors() == (0, 0)
+        settle()
+        positions = {}
+
+        def poll(maestro, channel):
+            positions[channel] = {maestro.get_position(channel) for i in range(200)}
+
+        threads = [threading.Thread(target=poll, args=args) for args in ((servo, 0), (threaded, 1))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert positions == {0: {7000}, 1: {5000}}
+    finally:
+        threaded.close()
+
+
+def test_resync_replays_streamed_targets(emulator, servo):
+    servo.set_target(0, 8000)
+    servo.set_target(1, 4000)
+    report = TrajectoryStreamer(servo, channels=[0, 2], rate=200).run([(6000, 6000), (5000, 7000)])
+    assert report.ticks == 2
+    with emulator.lock:
+        emulator.targets[:3] = [6000, 6000, 6000]
+    assert servo.resync() == (0, 0)
+    assert servo.get_errors() == (0, 0)
+    assert emulator.targets[:3] == [5000, 4000, 7000]
+
+
+def test_pool_failed_write_records_no_device(emulator, monkeypatch):
+    device = emulator.device
+    with MaestroPool([(emulator.port, device, 6), (emulator.port, device + 1, 6)]) as pool:
+        first, second = pool.controllers
+        assert pool.set_targets({0: 7000, 6: 5000})
+        assert first._sent == {('target', 0): 7000}
+        assert second._sent == {('target', 0): 5000}
+
+        def timeout(data):
+            raise serial.SerialTimeoutException('Write timeout')
+
+        monkeypatch.setattr(first._commandPort, 'write', timeout)
+        with pytest.raises(serial.SerialTimeoutException):
+            pool.set_targets({1: 7000, 7: 5000})
+        assert first._sent == {('target', 0): 7000}
+        assert second._sent == {('target', 0): 5000}
+        assert not first._unsent and not second._unsent
+
+
+def test_telemetry_ring_wraps_around(tmp_path, emulator, servo):
+    pytest.importorskip('numpy')
+    from ..telemetry import TelemetryLog, TelemetryRecorder
+
+    path = tmp_path / 'run.rec'
+    with TelemetryRecorder(servo, path, channels=[0, 2], capacity=5) as recorder:
+        for target in range(4000, 4800, 100):
+            servo.set_targets({0: target, 2: target + 1})
+            settle()
+            assert recorder.sample()
+    log = TelemetryLog(path)
+    try:
+        assert (log.count, len(log)) == (8, 5)
+        views = log.views()
+        assert [len(view) for view in views] == [2, 3]
+        records = log.records()
+        assert records['positions'][:, 0].tolist() == [4300, 4400, 4500, 4600, 4700]
+        assert records['positions'][:, 1].tolist() == [4301, 4401, 4501, 4601, 4701]
+        assert (records['time'][1:] >= records['time'][:-1]).all()
+        assert [positions for stamp, errors, positions in log] == [(t, t + 1) for t in range(4300, 4800, 100)]
+        del views, records
+    finally:
+        log.close()
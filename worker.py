@@ -0,0 +1,177 @@
+# coding: utf-8
+"""
+@namespace maestro
+Background I/O thread of a Maestro, see Maestro.start_worker.
+
+Any number of threads queue commands without waiting for the port. Each command is encoded on the
+thread queuing it, so a bad argument raises there. The worker thread is the only one using the port:
+each time it wakes up it takes everything queued, joins it into one buffer, writes it with one write
+and one flush, then reads the replies of the queries in order and hands them back through
+futures. A target queued for a channel which still has a target waiting replaces it (latest wins); the
+other commands are sent in the order they were queued.
+"""
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from itertools import count
+from time import perf_counter
+
+from .driver import ReadError
+from .encoder import Encoder
+
+logger = logging.getLogger(__name__)
+
+
+class IOWorker(threading.Thread):
+    """Thread writing the commands queued for a Maestro in batches"""
+
+    def __init__(self, servo):
+        """Class constructor block
+
+        @param servo The Maestro whose port the worker uses
+        @return New IOWorker object, call start to run it
+        """
+        super().__init__(name='maestro-io', daemon=True)
+        self._servo = servo
+        self._cond = threading.Condition()
+        # key -> ('set_target', (channel, target), None) or (None, encoded bytes, (size, timeout, future) of a
+        # query or None)
+        self._ops = OrderedDict()
+        self._local = threading.local()  # encoder of each thread queuing commands
+        self._order = count()
+        self._running = True
+        self._buffer = bytearray()
+        self.batches = 0
+
+    def _queue(self, key, op):
+        with self._cond:
+            if not self._running:
+                return False
+            self._ops.pop(key, None)
+            self._ops[key] = op
+            self._cond.notify()
+        return True
+
+    def _encode(self, name, args):
+        """Encode a command on the calling thread
+        @return The bytes of encoder.<name>(*args)
+        """
+        encoder = getattr(self._local, 'encoder', None)
+        if encoder is None:
+            encoder = self._local.encoder = Encoder(self._servo.encoder.protocol, self._servo.encoder.device)
+        return bytes(getattr(encoder, name)(*args))
+
+    def put(self, name, args):
+        """Queue the command encoded by encoder.<name>(*args)
+        @return True if queued, False if the worker is stopped
+        @throws Exception raised by the encoder for bad arguments
+        """
+        if name in ('set_target', 'set_targets'):
+            # only checked here, the worker encodes the targets left once merged
+            self._encode(name, args)
+        if name == 'set_targets':
+            with self._cond:
+                if not self._running:
+                    return False
+                for channel, target in args[0].items():
+                    key = ('target', channel)
+                    self._ops.pop(key, None)
+                    self._ops[key] = ('set_target', (channel, target), None)
+                self._cond.notify()
+            return True
+        if name == 'set_target':
+            return self._queue(('target', args[0]), (name, args, None))
+        return self._queue(next(self._order), (None, self._encode(name, args), None))
+
+    def put_raw(self, data):
+        """Queue bytes to write as they are
+        @return True if queued, False if the worker is stopped
+        """
+        return self._queue(next(self._order), (None, bytes(data), None))
+
+    def query(self, name, args, size, timeout=None):
+        """Queue the request encoded by encoder.<name>(*args) and wait for its reply
+        @param[in] size The size of the reply
+        @param[in] timeout The read timeout in seconds, the port timeout if None
+        @return The reply
+        @throws ReadError if the reply is incomplete or the worker is stopped
+        """
+        future = Future()
+        if not self._queue(next(self._order), (None, self._encode(name, args), (size, timeout, future))):
+            raise ReadError('I/O worker stopped')
+        return future.result()
+
+    def stop(self):
+        """Send what is queued and end the thread"""
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._ops:
+                    self._cond.wait()
+                if not self._ops:
+                    return
+                ops, self._ops = self._ops, OrderedDict()
+            try:
+                # the port may be shared with other Maestros, see ports.lock
+                with self._servo._portLock:
+                    self._process(ops.values())
+            except Exception:
+                logger.exception('I/O worker batch failed')
+
+    def _process(self, ops):
+        servo = self._servo
+        encoder = servo.encoder
+        buf = self._buffer
+        replies = [reply for name, args, reply in ops if reply is not None]
+        port = servo._commandPort
+        stats = servo._stats
+        try:
+            targets = {}
+            for name, args, reply in ops:
+                if name == 'set_target':
+                    targets[args[0]] = args[1]
+                    continue
+                if targets:
+                    buf += encoder.set_targets(targets)
+                    targets = {}
+                buf += args
+            if targets:
+                buf += encoder.set_targets(targets)
+
+            if not servo.is_open():
+                raise ReadError('port closed')
+            if stats is None:
+                port.write(buf)
+                port.flush()
+            else:
+                start = perf_counter()
+                port.write(buf)
+                written = perf_counter()
+                port.flush()
+                stats.write(written - start, len(buf))
+                stats.flush(perf_counter() - written)
+        except BaseException as e:
+            # nothing of the batch was sent: every query fails, none waits forever
+            for size, timeout, future in replies:
+                future.set_exception(e)
+            raise
+        finally:
+            del buf[:]
+        self.batches += 1
+
+        for i, (size, timeout, future) in enumerate(replies):
+            try:
+                future.set_result(servo._read(size, timeout))
+            except Exception as e:
+                # the replies left cannot be matched to their requests any more
+                port.reset_input_buffer()
+                for size, timeout, future in replies[i:]:
+                    future.set_exception(e)
+                break